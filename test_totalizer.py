@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TOTALIZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tripadvisor-totalizer.py')
+
+HEADLINE = b'Title|Text|Review URL\n'
+
+
+# Runs the totalizer on a session directory with the working directory the totalizer writes into
+def totalize(working_directory, session_path, *options):
+    subprocess.run([sys.executable, TOTALIZER, session_path] + list(options), cwd=working_directory, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    with open(os.path.join(working_directory, 'totalized', os.path.basename(session_path), 'reviews.csv'), 'rb') as reviews_csv:
+        return reviews_csv.read().splitlines()
+
+
+class IncrementalTotalizerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.working_directory = self.directory.name
+        os.makedirs(os.path.join(self.working_directory, 'logs'))
+
+        self.session_path = os.path.join(self.working_directory, 'data', '20160601-152200-vienna')
+        self.hotel_path = os.path.join(self.session_path, 'hotel-sacher-vienna')
+        os.makedirs(self.hotel_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_reviews(self, *rows):
+        with open(os.path.join(self.hotel_path, 'hotel-sacher-vienna-reviews.csv'), 'wb') as reviews_csv:
+            reviews_csv.write(HEADLINE + b''.join(row + b'\n' for row in rows))
+
+    def test_hotel_merged_before_its_csv_file_was_written(self):
+        # The writer has not flushed the first batch of the hotel yet
+        first_run = totalize(self.working_directory, self.session_path, '--incremental')
+        self.assertEqual(len(first_run), 1)
+
+        self.write_reviews(b'Great|Nice stay|/ShowUserReviews-1', b'Fine|Ok|/ShowUserReviews-2')
+        second_run = totalize(self.working_directory, self.session_path, '--incremental')
+
+        self.assertEqual(second_run[1:], [b'Great|Nice stay|/ShowUserReviews-1', b'Fine|Ok|/ShowUserReviews-2'])
+
+    def test_only_appended_rows_are_merged_again(self):
+        self.write_reviews(b'Great|Nice stay|/ShowUserReviews-1')
+        totalize(self.working_directory, self.session_path, '--incremental')
+
+        self.write_reviews(b'Great|Nice stay|/ShowUserReviews-1', b'Fine|Ok|/ShowUserReviews-2')
+        second_run = totalize(self.working_directory, self.session_path, '--incremental')
+
+        self.assertEqual(second_run[1:], [b'Great|Nice stay|/ShowUserReviews-1', b'Fine|Ok|/ShowUserReviews-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,344 @@
+import argparse
+import os
+import sys
+import re
+import json
+import time
+import random
+import shlex
+import shutil
+import tempfile
+import subprocess
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Scripts of the benchmark (next to this file)
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRAPPER_PATH = os.path.join(SCRIPT_DIRECTORY, 'tripadvisor-scrapper.py')
+TOTALIZER_PATH = os.path.join(SCRIPT_DIRECTORY, 'tripadvisor-totalizer.py')
+
+# City of the stand-in site
+CITY_ID = '1'
+CITY_NAME = 'Benchmark_City'
+
+# Peak RSS of a child process is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Synthetic city, hotel, review and member pages with the markup read by the scrapper
+class StandInSite(object):
+    def __init__(self, hotels, reviews, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.hotels = hotels
+        self.reviews = reviews
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+
+        self.lock = Lock()
+        self.random = random.Random(seed)
+
+        # Responses per status code
+        self.responses = dict()
+
+    # Returns the status of the next response, errors and throttled responses are injected at random
+    def draw_status(self):
+        with self.lock:
+            chance = self.random.random()
+
+        if chance < self.error_rate:
+            return 500
+        elif chance < self.error_rate + self.throttle_rate:
+            return 429
+
+        return 200
+
+    def count(self, status):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    # Returns the page of a path, None if the path is unknown
+    def get_page(self, path):
+        match = re.match(r'/Hotels-g(\d+)(?:-oa(\d+))?-(\w+)-Hotels\.html', path)
+        if match:
+            return self.city_page(int(match.group(2) or 0), match.group(1), match.group(3))
+
+        match = re.match(r'/Hotel_Review-g(\d+)-d(\d+)-Reviews(?:-or(\d+))?-(\w+)-(\w+)\.html', path)
+        if match:
+            return self.hotel_page(int(match.group(2)) - 1000, int(match.group(3) or 0), match.group(1), match.group(5))
+
+        match = re.match(r'/ShowUserReviews-g(\d+)-d(\d+)-r(\d+)-(\w+)-(\w+)\.html', path)
+        if match:
+            return self.review_page(int(match.group(2)) - 1000, int(match.group(3)), match.group(1), match.group(5))
+
+        match = re.match(r'/members/(\w+)', path)
+        if match:
+            return self.member_page()
+
+        return None
+
+    def city_page(self, offset, city_id, city_name):
+        listings = ''
+
+        for hotel in range(offset, min(offset + 30, self.hotels)):
+            listings += ('<div class="listing" id="hotel_%d"><div class="listing_title">'
+                         '<a class="property_title" href="/Hotel_Review-g%s-d%d-Reviews-Hotel_%d-%s.html">Hotel %d</a></div>'
+                         '<span class="more"><a href="#">%s reviews</a></span></div>') % (1000 + hotel, city_id, 1000 + hotel, hotel, city_name, hotel, format(self.reviews, ','))
+
+        return '<html><body>%s<a class="last">%d</a></body></html>' % (listings, max((self.hotels + 29) // 30, 1))
+
+    def hotel_header(self, hotel):
+        return ('<a class="HEADING">Hotel %d</a><img class="sprite-rating_no_fill" alt="4.5 of 5"/><div class="slim_ranking">#%d of %d hotels</div>'
+                '<h3 class="reviews_header">%d reviews</h3><span class="format_address">Street %d</span>'
+                '<fieldset class="review_filter_lodging"><div class="col2of2"><div class="wrap"><span class="text">Excellent</span><span class="compositeCount">5</span></div></div></fieldset>'
+                '<div class="stars">Hotel Class: 4 star</div>') % (hotel, hotel + 1, self.hotels, self.reviews, hotel)
+
+    # The review ids of a hotel decrease from its newest (first) review on
+    def review_block(self, hotel, review_id, city_id, city_name):
+        return ('<div class="reviewSelector" id="review_%d"><div class="col1of2"><div class="member_info"><div class="username"><span class="scrname">user%d</span></div></div></div>'
+                '<div class="col2of2"><div class="quote"><a href="/ShowUserReviews-g%s-d%d-r%d-Hotel_%d-%s.html"><span class="noQuotes">Title %d</span></a></div>'
+                '<img class="sprite-rating_s_fill" alt="%d of 5 stars"/><span class="ratingDate" content="2016-01-%02d" title="January %d, 2016">Reviewed</span>'
+                '<div class="entry"><p class="partial_entry">Review text %d of hotel %d, café and breakfast were fine</p></div>'
+                '<span class="recommend-titleInline">Stayed January 2016, traveled as a couple</span><span class="numHlpIn">%d</span>'
+                '<ul class="recommend"><li><ul class="recommend-column"><li class="recommend-answer"><div class="recommend-description">Value</div><img class="sprite-rating_ss_fill" alt="4 of 5 stars"/></li></ul></li></ul>'
+                '</div></div>') % (review_id, review_id % 50, city_id, 1000 + hotel, review_id, hotel, city_name, review_id, review_id % 5 + 1, review_id % 28 + 1, review_id % 28 + 1, review_id, hotel, review_id % 3)
+
+    def hotel_page(self, hotel, offset, city_id, city_name):
+        blocks = ''
+
+        for review in range(offset, min(offset + 10, self.reviews)):
+            review_id = (hotel + 1) * 1000000 + self.reviews - review
+            blocks += '<div class="basic_review">' + self.review_block(hotel, review_id, city_id, city_name).replace('class="reviewSelector"', 'class="reviewSelector inner"') + '</div>'
+
+        return '<html><body>%s%s<a class="pageNum">1</a><a class="pageNum">%d</a></body></html>' % (self.hotel_header(hotel), blocks, max((self.reviews + 9) // 10, 1))
+
+    def review_page(self, hotel, review_id, city_id, city_name):
+        return '<html><body>%s%s</body></html>' % (self.hotel_header(hotel), self.review_block(hotel, review_id, city_id, city_name))
+
+    def member_page(self):
+        return ('<html><body><div class="level"><span>Level 3</span></div><div class="ageSince"><p>Since 2010</p><p>30-49 man</p></div>'
+                '<div class="hometown"><p>Vienna</p></div><a data-filter="REVIEWS_ALL">12 Reviews</a><a data-filter="RATINGS_ALL">3 Ratings</a>'
+                '<a data-filter="PHOTOS_ALL">4 Photos</a><a data-filter="REVIEWS_ALL">5 helpful</a><div class="tagBlock"><div class="tagBubble">Foodie</div></div></body></html>')
+
+
+# Serves the pages of the stand-in site of the server
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately, Nagle's algorithm would delay the body of a kept alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        site = self.server.site
+
+        if site.latency:
+            time.sleep(site.latency)
+
+        page = site.get_page(self.path.split('#')[0])
+        status = site.draw_status() if page is not None else 404
+        body = page.encode('utf-8') if status == 200 else b''
+
+        site.count(status)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+
+        if status == 429:
+            self.send_header('Retry-After', '0')
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Start the stand-in site on a free local port, returns the server
+def start_stand_in_site(site):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInRequestHandler)
+    server.daemon_threads = True
+    server.site = site
+
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+# Run a script in a working directory, returns its duration, exit code and peak RSS in kilobytes (None if unavailable)
+def run_script(arguments, working_directory):
+    with open(os.path.join(working_directory, 'output.txt'), 'ab') as output_file:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + arguments, cwd=working_directory, stdout=output_file, stderr=subprocess.STDOUT)
+
+        # wait4 reports the resource usage of this child only
+        if hasattr(os, 'wait4') and resource is not None:
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+        else:
+            process.wait()
+            peak_rss = None
+
+        return time.perf_counter() - started, process.returncode, peak_rss
+
+
+# Read the samples of a metrics file of the scrapper as {name: [(labels, value)]}
+def read_metrics_file(path):
+    samples = dict()
+
+    with open(path, 'r', encoding='utf-8') as metrics_file:
+        for line in metrics_file:
+            match = re.match(r'(\w+)(?:\{(.*)\})? (\S+)$', line.strip())
+
+            if match is None or line.startswith('#'):
+                continue
+
+            labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or ''))
+            samples.setdefault(match.group(1), list()).append((labels, float(match.group(3))))
+
+    return samples
+
+
+# Sum the samples of a metric, optionally only the ones with a label value
+def sum_metric(samples, name, label=None, value=None):
+    return sum(sample for labels, sample in samples.get(name, []) if label is None or labels.get(label) == value)
+
+
+# Run the scrapper against the stand-in site, returns its results
+def benchmark_scrapper(base_url, working_directory, scrapper_arguments):
+    for directory in ['logs', 'data', 'pickle', 'cache']:
+        os.makedirs(os.path.join(working_directory, directory), exist_ok=True)
+
+    metrics_path = os.path.join(working_directory, 'metrics.prom')
+    arguments = [SCRAPPER_PATH, CITY_ID, CITY_NAME, '--base-url', base_url, '--metrics-file', metrics_path] + scrapper_arguments
+
+    duration, exit_code, peak_rss = run_script(arguments, working_directory)
+
+    if not os.path.isfile(metrics_path):
+        return {'duration': duration, 'exit_code': exit_code, 'peak_rss_kb': peak_rss}
+
+    samples = read_metrics_file(metrics_path)
+    requests_count = sum_metric(samples, 'tripadvisor_requests_total')
+    reviews_count = sum_metric(samples, 'tripadvisor_reviews_written_total')
+
+    # Time spent retrieving and parsing the pages of each stage (summed over all concurrent requests)
+    stages = dict()
+
+    for labels, sample in samples.get('tripadvisor_requests_total', []):
+        stage = stages.setdefault(labels['stage'], {'requests': 0, 'fetch_seconds': 0.0, 'parse_seconds': 0.0})
+        stage['requests'] += int(sample)
+
+    for stage_name, stage in stages.items():
+        stage['fetch_seconds'] = round(sum_metric(samples, 'tripadvisor_fetch_seconds_sum', 'stage', stage_name), 3)
+        stage['parse_seconds'] = round(sum_metric(samples, 'tripadvisor_parse_seconds_sum', 'stage', stage_name), 3)
+
+    return {
+        'duration': round(duration, 3),
+        'exit_code': exit_code,
+        'peak_rss_kb': peak_rss,
+        'requests': int(requests_count),
+        'requests_per_second': round(requests_count / duration, 2),
+        'reviews': int(reviews_count),
+        'reviews_per_second': round(reviews_count / duration, 2),
+        'skipped_reviews': int(sum_metric(samples, 'tripadvisor_reviews_skipped_total')),
+        'retries': int(sum_metric(samples, 'tripadvisor_retries_total')),
+        'bytes': int(sum_metric(samples, 'tripadvisor_transferred_bytes_total')),
+        'stages': stages
+    }
+
+
+# Run the totalizer on the session directory of the scrapper, returns its results (None if there is no session directory)
+def benchmark_totalizer(working_directory, totalizer_arguments):
+    data_path = os.path.join(working_directory, 'data')
+    sessions = [name for name in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, name))]
+
+    # A failed scrapper run may not have created a session directory
+    if not sessions:
+        return None
+
+    duration, exit_code, peak_rss = run_script([TOTALIZER_PATH, os.path.join(data_path, sessions[0])] + totalizer_arguments, working_directory)
+
+    return {'duration': round(duration, 3), 'exit_code': exit_code, 'peak_rss_kb': peak_rss}
+
+
+# Print the changes of the main numbers compared to a previous result
+def print_comparison(results, previous_results):
+    for part, keys in [('scrapper', ['duration', 'requests_per_second', 'reviews_per_second', 'peak_rss_kb']), ('totalizer', ['duration', 'peak_rss_kb'])]:
+        current = results.get(part) or dict()
+        previous = previous_results.get(part) or dict()
+
+        for key in keys:
+            if current.get(key) is None or not previous.get(key):
+                continue
+
+            print('%-10s %-20s %12s -> %12s  %+7.1f%%' % (part, key, previous[key], current[key], (current[key] - previous[key]) * 100.0 / previous[key]))
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='benchmark the scrapper and the totalizer end to end against a local stand-in site', usage='python tripadvisor-benchmark.py [--hotels 20] [--reviews 50] [--latency 0.02] [--scrapper-args "--concurrency 8"] [--compare benchmarks/previous.json]')
+    parser.add_argument('--hotels', type=int, default=20, help='the number of hotels of the city (default: 20)')
+    parser.add_argument('--reviews', type=int, default=50, help='the number of reviews per hotel (default: 50)')
+    parser.add_argument('--latency', type=float, default=0.0, help='the seconds the site waits before each response (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the share of responses answered with 500 (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='the share of responses answered with 429 (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the injected errors and throttled responses (default: 0)')
+    parser.add_argument('--scrapper-args', default='', help='additional arguments of the scrapper, e.g. "--concurrency 8 --review-source listing"')
+    parser.add_argument('--totalizer-args', default='', help='additional arguments of the totalizer, e.g. "--workers 4"')
+    parser.add_argument('--output', help='the file the results are stored in as JSON (default: benchmarks/timestamp.json)')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the ones of a previous benchmark')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory of the scrapper')
+    args = parser.parse_args()
+
+    site = StandInSite(args.hotels, args.reviews, args.latency, args.error_rate, args.throttle_rate, args.seed)
+    server = start_stand_in_site(site)
+    base_url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    working_directory = tempfile.mkdtemp(prefix='tripadvisor-benchmark-')
+    started = time.strftime('%Y%m%d-%H%M%S')
+
+    print('%d hotels with %d reviews at %s (latency %.3f s, error rate %.2f, throttle rate %.2f)' % (args.hotels, args.reviews, base_url, args.latency, args.error_rate, args.throttle_rate))
+
+    try:
+        scrapper_results = benchmark_scrapper(base_url, working_directory, shlex.split(args.scrapper_args))
+        totalizer_results = benchmark_totalizer(working_directory, shlex.split(args.totalizer_args))
+    finally:
+        server.shutdown()
+
+        if not args.keep:
+            shutil.rmtree(working_directory, ignore_errors=True)
+
+    results = {
+        'started': started,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'site': {'hotels': args.hotels, 'reviews': args.reviews, 'latency': args.latency, 'error_rate': args.error_rate, 'throttle_rate': args.throttle_rate, 'seed': args.seed, 'responses': dict((str(status), count) for status, count in sorted(site.responses.items()))},
+        'scrapper_args': args.scrapper_args,
+        'totalizer_args': args.totalizer_args,
+        'scrapper': scrapper_results,
+        'totalizer': totalizer_results
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.keep:
+        print('Working directory: ' + working_directory)
+
+    # Store the results for later comparisons
+    output_path = args.output or os.path.join('benchmarks', started + '.json')
+
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print('Stored results in ' + output_path)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as previous_file:
+            print_comparison(results, json.load(previous_file))
@@ -0,0 +1,128 @@
+import argparse
+import importlib.util
+import os
+import sqlite3
+import gzip
+import time
+from bs4 import BeautifulSoup
+
+# Load the scrapper (its file name is not importable as module)
+spec = importlib.util.spec_from_file_location('scrapper', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tripadvisor-scrapper.py'))
+scrapper = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(scrapper)
+
+BASE_URL = 'https://www.tripadvisor.com/'
+
+
+# Get the stages reading a page and their extractors out of the page url (or file name)
+def get_extractors(url):
+    name = url.replace(BASE_URL, '').split('/')[-1]
+
+    if name.startswith('Hotels-'):
+        return [
+            ('city-pagination', scrapper.extract_number_of_pages_in_city),
+            ('city-hotels', lambda soup: scrapper.extract_hotels(soup, BASE_URL))
+        ]
+    elif name.startswith('Hotel_Review-'):
+        return [
+            ('hotel-pagination', scrapper.extract_maximum_pagination_of_hotel),
+            ('hotel-reviews', lambda soup: scrapper.extract_reviews_of_page(soup, BASE_URL, True))
+        ]
+    elif name.startswith('ShowUserReviews-'):
+        return [
+            ('hotel-information', scrapper.extract_hotel_information),
+            ('review-information', lambda soup: scrapper.extract_review_information(soup, url))
+        ]
+    elif 'members' in url:
+        return [
+            ('reviewer-information', lambda soup: scrapper.extract_reviewer_information(soup, name, url))
+        ]
+
+    return []
+
+
+# Load the sample pages of a directory (named like the page urls, members pages prefixed with members-)
+def load_sample_pages_of_directory(directory_path):
+    pages = list()
+
+    for file_name in sorted(os.listdir(directory_path)):
+        with open(os.path.join(directory_path, file_name), 'rb') as sample_file:
+            url = file_name.replace('members-', 'members/')
+            pages.append((url, sample_file.read()))
+
+    return pages
+
+
+# Load the sample pages stored in the response cache
+def load_sample_pages_of_cache(cache_path, limit):
+    pages = list()
+
+    connection = sqlite3.connect(os.path.join(cache_path, 'responses.sqlite'))
+
+    for url, digest in connection.execute('SELECT url, digest FROM responses ORDER BY fetched_at LIMIT ?', (limit,)):
+        with gzip.open(os.path.join(cache_path, 'bodies', digest[:2], digest + '.gz'), 'rb') as body_file:
+            pages.append((url, body_file.read()))
+
+    connection.close()
+
+    return pages
+
+
+# Parse and extract all sample pages with a backend, regions restricts the parsing to the regions read by the stages
+def run_backend(pages, parser_name, regions, repeat):
+    results = list()
+    started = time.perf_counter()
+
+    for i in range(repeat):
+        results = list()
+
+        for url, content in pages:
+            for stage, extractor in get_extractors(url):
+                parse_only = scrapper.DOCUMENT_REGIONS.get(stage) if regions else None
+                soup = BeautifulSoup(content, parser_name, parse_only=parse_only)
+
+                try:
+                    results.append(extractor(soup))
+                except Exception as err:
+                    results.append(type(err).__name__)
+
+    return time.perf_counter() - started, results
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='compare the parser backends on stored sample pages', usage='python tripadvisor-parser-benchmark.py [--samples samples] [--repeat 3]')
+    parser.add_argument('--samples', help='directory of sample pages named like their urls (default: pages of the response cache)')
+    parser.add_argument('--cache', default='cache/responses', help='the response cache directory used if no samples are given')
+    parser.add_argument('--limit', type=int, default=500, help='the maximum number of pages loaded from the response cache (default: 500)')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of rounds over all pages (default: 3)')
+    args = parser.parse_args()
+
+    if args.samples:
+        sample_pages = load_sample_pages_of_directory(args.samples)
+    else:
+        sample_pages = load_sample_pages_of_cache(args.cache, args.limit)
+
+    backends = [('html.parser', False), ('html.parser', True)]
+
+    if scrapper.DEFAULT_PARSER == 'lxml':
+        backends += [('lxml', False), ('lxml', True)]
+
+    print('%d sample pages, %d rounds' % (len(sample_pages), args.repeat))
+
+    reference_results = None
+    reference_duration = None
+
+    for parser_name, regions in backends:
+        duration, results = run_backend(sample_pages, parser_name, regions, args.repeat)
+
+        # The first backend (html.parser on whole documents) is the reference of speed and results
+        if reference_results is None:
+            reference_results = results
+            reference_duration = duration
+
+        print('%-12s %-8s %8.3f s  %6.2fx  %s' % (
+            parser_name, 'regions' if regions else 'full', duration, reference_duration / duration,
+            'same results' if results == reference_results else 'DIFFERENT RESULTS'
+        ))
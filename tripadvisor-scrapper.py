@@ -1,339 +1,2496 @@
 import argparse
+import sys
 import logging
+import logging.handlers
+import atexit
 import requests
 import time
 import os
 import csv
-from bs4 import BeautifulSoup
-from functools import wraps
+from bs4 import BeautifulSoup, SoupStrainer
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import deque, OrderedDict
+from array import array
+from bisect import bisect_left
+from threading import Lock, Event, Thread, Condition, local, get_ident
+from queue import Queue, PriorityQueue, Empty
+from urllib.parse import urldefrag
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pickle
+import sqlite3
+import json
+import re
+import hashlib
+import socket
+import gzip
+import tripadvisor_pack
+import tripadvisor_frontier
+import tripadvisor_urls
+
+# Use the fast lxml parser if it is installed
+try:
+    import lxml
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+# Regions of the pages read by each stage, only these are parsed (None parses the whole document)
+DOCUMENT_REGIONS = {
+    'city-pagination': SoupStrainer('a', attrs={'class': 'last'}),
+    'city-hotels': SoupStrainer(attrs={'class': ['property_title', 'more']}),
+    'hotel-pagination': SoupStrainer('a', attrs={'class': 'pageNum'}),
+    'hotel-reviews': SoupStrainer('div', attrs={'class': 'basic_review'}),
+    'hotel-information': None,
+    'review-information': SoupStrainer('div', attrs={'class': 'reviewSelector'}),
+    'reviewer-information': None
+}
+
+# Parser backend of all documents (set up in main according to --parser)
+document_parser = DEFAULT_PARSER
+
+# Worker pool shared by all scraping stages (set up in main according to --concurrency)
+fetch_pool = None
+fetch_window = 1
+
+# HTTP transport shared by all scraping stages (set up in main)
+transport = None
+
+# Cache of parsed reviewers and hotels shared by all cities and sessions (set up in main)
+entity_cache = None
+
+# Seconds an entity without information (e.g. parsed from an error page) is served from memory before it is retrieved again
+FAILED_ENTITY_TTL = 300
+
+# Cache of raw responses below get_request_with_retry (set up in main according to --cache-mode)
+response_cache = None
+
+# Registry of the pages retrieved during the current run (set up in main)
+page_registry = None
+
+# Process pool which parses the retrieved pages (set up in main according to --parser-processes)
+parser_pool = None
+
+# Current depths of the fetch, parse and write stages of the pipeline
+queue_depths = {'fetch': 0, 'parse': 0, 'write': 0}
+queue_depths_lock = Lock()
+
+# Output format of the reviews and the number of reviews written at once (set up in main according to --output and --write-batch-size)
+output_format = 'csv'
+write_batch_size = 100
+
+# Seconds without new reviews after which an incomplete batch is written anyway
+WRITE_IDLE_TIMEOUT = 5
+
+# Newest stored review of each hotel of previous runs (set up in main according to --since-last-run)
+review_history = None
+
+# Ids of the reviews stored by previous runs, they are not retrieved again (set up in main according to --skip-known-reviews)
+review_index = None
+
+# Controller of the request rate and concurrency per host (set up in main according to --adaptive)
+rate_controller = None
+
+# Storage of the review texts of the csv output, files per review or one pack per session (set up in main according to --review-texts)
+review_text_store = 'files'
+
+
+# Per-url log events are the lazily formatted records with these prefixes, one-off messages are never sampled
+PER_URL_EVENTS = ('STARTED: ', 'FINISHED: ', 'PROCESSED: ')
+
+
+# Shows a long path without its \\?\ prefix once a log record is formatted
+class LogPath(object):
+    __slots__ = ('path', )
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path.replace('\\\\?\\', '')
+
+
+# Hands the records to the listener thread without formatting them, the calling thread only enqueues them
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Passes one of every rate per-url events of each kind and counts all of them
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=1):
+        super(SamplingFilter, self).__init__()
+        self.rate = max(rate, 1)
+        self.lock = Lock()
+
+        # Number of events and logged events per message template and emitting function
+        self.events = dict()
+
+    def filter(self, record):
+        if not record.args or not isinstance(record.msg, str) or not record.msg.startswith(PER_URL_EVENTS):
+            return True
+
+        key = (record.msg, record.funcName)
+
+        with self.lock:
+            counts = self.events.get(key)
+
+            if counts is None:
+                counts = self.events[key] = [0, 0]
+
+            passed = counts[0] % self.rate == 0
+            counts[0] += 1
+            counts[1] += passed
+
+        return passed
+
+    # Returns the number of events and logged events per kind (the message template up to its first argument and the emitting function)
+    def get_rollups(self):
+        rollups = dict()
+
+        with self.lock:
+            for (template, function_name), (number_of_events, logged_events) in self.events.items():
+                kind = template.split('%')[0].rstrip(' (:') + ' (' + function_name + ')'
+                previous = rollups.get(kind, (0, 0))
+                rollups[kind] = (previous[0] + number_of_events, previous[1] + logged_events)
+
+        return rollups
+
+
+# Formats records as JSON lines with the event kind, the message and its arguments as separate fields
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+
+        kind = re.match(r'([A-Z][A-Z ]*[A-Z]):', str(record.msg))
+
+        if kind is not None:
+            event['event'] = kind.group(1)
+
+        if record.args:
+            event['args'] = [arg if isinstance(arg, (int, float)) else str(arg) for arg in record.args]
+
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(event, ensure_ascii=False)
+
+
+# Sampling of the per-url log events (set up in main according to --log-sample)
+log_sampling = SamplingFilter()
+
+
+# Log the number of per-url events of each kind and how many of them were logged
+def log_event_rollups():
+    for kind, (number_of_events, logged_events) in sorted(log_sampling.get_rollups().items()):
+        logger.info('ROLLUP: ' + kind + ': ' + str(number_of_events) + ' events, ' + str(logged_events) + ' logged')
+
+
+# Type, help text and histogram buckets of the metrics of a run
+METRIC_DESCRIPTIONS = {
+    'requests_total': ('counter', 'Responses received per stage and status code', None),
+    'transferred_bytes_total': ('counter', 'Bytes transferred per stage', None),
+    'fetch_seconds': ('histogram', 'Duration of the requests per stage', (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'parse_seconds': ('histogram', 'Duration of parsing a page per stage (including the extraction in parser processes)', (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)),
+    'retries_total': ('counter', 'Requests failed with an error or throttled with --adaptive, they are repeated', None),
+    'pages_extracted_total': ('counter', 'Pages extracted per stage', None),
+    'reviews_discovered_total': ('counter', 'Review urls handed to the review stage', None),
+    'reviews_written_total': ('counter', 'Reviews written per output format', None),
+    'reviews_skipped_total': ('counter', 'Reviews skipped due to errors or missing information', None),
+    'reviews_deduplicated_total': ('counter', 'Review urls not retrieved because they were listed before in the run (duplicate) or stored by a previous run (known)', None),
+    'reviews_expected': ('gauge', 'Reviews of the runs whose review urls are known in advance', None),
+    'discoveries_running': ('gauge', 'Cities whose review urls are still discovered', None),
+    'queue_depth': ('gauge', 'Items waiting in a pipeline stage', None),
+    'host_concurrency_limit': ('gauge', 'Requests in flight allowed per host by the rate controller', None),
+    'host_rate_limit': ('gauge', 'Requests per second allowed per host by the rate controller (0 is unpaced)', None),
+    'cache_hits_total': ('counter', 'Hits of the response and entity caches', None),
+    'cache_misses_total': ('counter', 'Misses of the response and entity caches', None),
+    'log_events_total': ('counter', 'Per-url log events per kind, including the ones dropped by --log-sample', None)
+}
+
+
+# Counters, gauges and histograms of a run, rendered in the Prometheus text format
+class MetricsRegistry(object):
+    def __init__(self, prefix='tripadvisor_'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.started = time.time()
+
+        # Values by metric name and sorted label pairs, histograms hold their bucket counts, sum and count
+        self.values = dict()
+
+        # Callbacks returning the current (labels, value) pairs of a metric, e.g. queue depths
+        self.collectors = dict()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = METRIC_DESCRIPTIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            histogram = self.values.get(key)
+
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(buckets) + 2)
+
+            for i, bucket in enumerate(buckets):
+                if value <= bucket:
+                    histogram[i] += 1
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def register_collector(self, name, collector):
+        self.collectors[name] = collector
+
+    # Returns the sum of a counter over all of its labels
+    def get_total(self, name):
+        with self.lock:
+            return sum(value for (metric_name, labels), value in self.values.items() if metric_name == name)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+
+        return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+    # Renders all metrics in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+
+        for name, collector in self.collectors.items():
+            try:
+                values += [((name, tuple(sorted(labels.items()))), value) for labels, value in collector()]
+            except:
+                pass
+
+        lines = list()
+        described = set()
+
+        for (name, labels), value in values:
+            kind, help_text, buckets = METRIC_DESCRIPTIONS[name]
+
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP ' + self.prefix + name + ' ' + help_text)
+                lines.append('# TYPE ' + self.prefix + name + ' ' + kind)
+
+            if kind == 'histogram':
+                for bucket, count in zip(buckets + ('+Inf', ), value[:len(buckets)] + [value[-1]]):
+                    lines.append(self.prefix + name + '_bucket' + self.format_labels(labels + (('le', bucket), )) + ' ' + str(count))
+
+                lines.append(self.prefix + name + '_sum' + self.format_labels(labels) + ' ' + repr(float(value[-2])))
+                lines.append(self.prefix + name + '_count' + self.format_labels(labels) + ' ' + str(value[-1]))
+            else:
+                lines.append(self.prefix + name + self.format_labels(labels) + ' ' + str(value))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the current run (exposed in main according to --metrics-file and --metrics-port)
+metrics = MetricsRegistry()
+
+
+# Serves the metrics of the run at /metrics
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Writes the metrics into a file (replaced atomically, e.g. for the textfile collector of the node exporter)
+def write_metrics_file(path):
+    with open(path + '.tmp', 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(metrics.render())
+
+    os.replace(path + '.tmp', path)
+
+
+# Logs the progress of the run with the review rate of the last interval and the estimated remaining time
+def log_progress(previous):
+    now = time.time()
+    finished = metrics.get_total('reviews_written_total') + metrics.get_total('reviews_skipped_total')
+    requests_count = metrics.get_total('requests_total')
+
+    elapsed = max(now - previous[0], 0.001)
+    review_rate = (finished - previous[1]) / elapsed
+    request_rate = (requests_count - previous[2]) / elapsed
+
+    # The discovered reviews are a lower bound of the total while the review urls are still discovered
+    total = max(metrics.get_total('reviews_expected'), metrics.get_total('reviews_discovered_total'))
+    completed = metrics.get_total('discoveries_running') == 0
+
+    if review_rate > 0:
+        eta = time.strftime('%H:%M:%S', time.gmtime((total - finished) / review_rate)) + ('' if completed else '+')
+    else:
+        eta = 'n.a.'
+
+    logger.info('PROGRESS: ' + str(finished) + ' of ' + str(total) + ('' if completed else '+') + ' reviews, ' + '%.1f reviews/s, %.1f requests/s' % (review_rate, request_rate) + ', ETA ' + eta)
+
+    return now, finished, requests_count
+
+
+# Reports the progress and writes the metrics file every interval until stop is set
+def report_metrics(stop, interval, metrics_file_path=None):
+    previous = (metrics.started, 0, 0)
+
+    while not stop.wait(interval):
+        previous = log_progress(previous)
+
+        if metrics_file_path:
+            write_metrics_file(metrics_file_path)
+
+
+# Current depths of the pipeline stages and limits of the rate controller as metrics
+def collect_queue_depths():
+    with queue_depths_lock:
+        return [(dict(stage=stage), depth) for stage, depth in sorted(queue_depths.items())]
+
+
+def collect_host_concurrency_limits():
+    if rate_controller is None:
+        return []
+
+    return [(dict(host=name), round(concurrency, 2)) for name, (concurrency, rate) in sorted(rate_controller.get_limits().items())]
+
+
+def collect_host_rate_limits():
+    if rate_controller is None:
+        return []
+
+    return [(dict(host=name), round(rate or 0, 3)) for name, (concurrency, rate) in sorted(rate_controller.get_limits().items())]
+
+
+def collect_cache_hits():
+    hits = list()
+
+    if response_cache is not None:
+        hits.append((dict(cache='responses'), response_cache.hits))
+
+    if entity_cache is not None:
+        hits += [(dict(cache=kind), count) for kind, count in sorted(entity_cache.hits.items())]
+
+    return hits
+
+
+def collect_log_events():
+    return [(dict(event=kind), number_of_events) for kind, (number_of_events, logged_events) in sorted(log_sampling.get_rollups().items())]
+
+
+def collect_cache_misses():
+    misses = list()
+
+    if response_cache is not None:
+        misses.append((dict(cache='responses'), response_cache.misses))
+
+    if entity_cache is not None:
+        misses += [(dict(cache=kind), count) for kind, count in sorted(entity_cache.misses.items())]
+
+    return misses
+
+
+metrics.register_collector('queue_depth', collect_queue_depths)
+metrics.register_collector('host_concurrency_limit', collect_host_concurrency_limits)
+metrics.register_collector('host_rate_limit', collect_host_rate_limits)
+metrics.register_collector('cache_hits_total', collect_cache_hits)
+metrics.register_collector('cache_misses_total', collect_cache_misses)
+metrics.register_collector('log_events_total', collect_log_events)
+
+
+# Keeps connections alive per host, negotiates compression and remembers canonical redirect targets
+class Transport(object):
+    def __init__(self, header, pool_size, timeout=None):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(header)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # Keep at least one connection per worker alive for each host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = Lock()
+        self.redirects = dict()
+        self.prefix_redirects = dict()
+        self.statistics = dict()
+
+    # Resolves an url to its canonical target if it has been redirected before
+    def resolve(self, url):
+        url = urldefrag(url)[0]
+
+        with self.lock:
+            if url in self.redirects:
+                return self.redirects[url]
+
+            for prefix, target in self.prefix_redirects.items():
+                if url.startswith(prefix):
+                    return target + url[len(prefix):]
+
+        return url
+
+    # Remembers the canonical target of a redirected url
+    def remember_redirect(self, url, target):
+        with self.lock:
+            self.redirects[url] = target
+
+            # A redirect which only changes scheme or host (e.g. http to https) applies to all urls of the host
+            url_path = url.split('/', 3)[3:]
+            target_path = target.split('/', 3)[3:]
+
+            if url_path == target_path:
+                url_prefix = url[:len(url) - len(url_path[0])] if url_path else url
+                target_prefix = target[:len(target) - len(target_path[0])] if target_path else target
+                self.prefix_redirects[url_prefix] = target_prefix
+
+    # Accounts the requests and transferred bytes of a stage
+    def count(self, stage, number_of_bytes):
+        with self.lock:
+            requests_count, bytes_count = self.statistics.get(stage, (0, 0))
+            self.statistics[stage] = (requests_count + 1, bytes_count + number_of_bytes)
+
+        metrics.increment('transferred_bytes_total', number_of_bytes, stage=stage)
+
+    def get(self, url, header, stage):
+        requested_url = self.resolve(url)
+        started = time.monotonic()
+
+        try:
+            response = self.session.get(requested_url, headers=header, timeout=self.timeout)
+        except:
+            metrics.increment('retries_total', stage=stage)
+            raise
+
+        metrics.observe('fetch_seconds', time.monotonic() - started, stage=stage)
+        metrics.increment('requests_total', stage=stage, status=response.status_code)
+
+        # Remember the canonical target to save the redirect hop next time
+        if response.history:
+            self.remember_redirect(requested_url, urldefrag(response.url)[0])
+
+        # Prefer the (compressed) number of bytes pulled over the wire
+        try:
+            number_of_bytes = response.raw.tell() or len(response.content)
+        except:
+            number_of_bytes = len(response.content)
+
+        self.count(stage, number_of_bytes)
+
+        return response
+
+
+# Request limits of a host controlled by the RateController
+class HostLimit(object):
+    def __init__(self, name, floor):
+        self.name = name
+        self.limit = float(floor)
+        self.in_flight = 0
+        self.interval = 0.0
+        self.next_slot = 0.0
+        self.slow_start = True
+        self.latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.failures = 0
+
+
+# Adjusts concurrency and rate per host: additive increase while requests succeed quickly,
+# multiplicative decrease on 429/503 responses, timeouts, errors and latency far above the observed baseline
+class RateController(object):
+    def __init__(self, floor, ceiling, min_rate=0.2, max_rate=0.0, tries=40, latency_tolerance=2.0, latency_slack=0.05):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.max_interval = 1.0 / min_rate if min_rate > 0 else 60.0
+        self.tries = max(tries, 1)
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self.condition = Condition()
+        self.hosts = dict()
+
+    def get_host(self, url):
+        name = url.split('/')[2] if url.count('/') >= 2 else url
+
+        if name not in self.hosts:
+            self.hosts[name] = HostLimit(name, self.floor)
+            self.hosts[name].interval = self.min_interval
+
+        return self.hosts[name]
+
+    # Waits until the host of the url allows another request and returns the host
+    def acquire(self, url):
+        with self.condition:
+            host = self.get_host(url)
+
+            while True:
+                now = time.monotonic()
+
+                if host.in_flight < int(host.limit) and now >= host.next_slot:
+                    host.in_flight += 1
+                    host.requests += 1
+                    host.next_slot = now + host.interval
+
+                    return host
+
+                # Wait for a released request or for the next slot of the pacing interval
+                self.condition.wait(host.next_slot - now if host.in_flight < int(host.limit) else None)
+
+    # Releases a request of a host and adjusts its limits according to the outcome
+    def release(self, host, latency, throttled=False, failed=False, retry_after=None):
+        with self.condition:
+            host.in_flight -= 1
+            now = time.monotonic()
+
+            if throttled or failed:
+                if throttled:
+                    host.throttled += 1
+                else:
+                    host.failures += 1
+
+                self.decrease(host, now, 0.5)
+
+                # Slow down the rate as well, a Retry-After header of the site takes precedence
+                host.interval = min(max(host.interval * 2, 0.25, self.min_interval), self.max_interval)
+
+                try:
+                    host.next_slot = max(host.next_slot, now + float(retry_after))
+                except (TypeError, ValueError):
+                    host.next_slot = max(host.next_slot, now + host.interval)
+            else:
+                host.latency = latency if host.latency is None else host.latency * 0.8 + latency * 0.2
+                host.baseline_latency = host.latency if host.baseline_latency is None else min(host.baseline_latency * 1.01, host.latency)
+
+                # The slack keeps the jitter of very fast responses from counting as congestion
+                if host.latency > host.baseline_latency * self.latency_tolerance + self.latency_slack:
+                    # The site slows down, back off before it starts to refuse requests
+                    self.decrease(host, now, 0.9)
+                else:
+                    # Grow by one request per window of requests (doubling during slow start)
+                    host.limit = min(self.ceiling, host.limit + (1.0 if host.slow_start else 1.0 / host.limit))
+                    host.interval = max(self.min_interval, host.interval * 0.8 if host.interval > 0.001 else 0.0)
+
+            self.condition.notify_all()
+
+    # Decreases the limit of a host at most once per latency window (requests in flight fail together)
+    def decrease(self, host, now, factor):
+        if now - host.last_decrease < (host.latency or 1.0):
+            return
+
+        previous_limit = host.limit
+        host.limit = max(self.floor, host.limit * factor)
+        host.slow_start = False
+        host.last_decrease = now
+
+        logger.info('LIMIT: ' + host.name + ' decreased from ' + '%.1f' % previous_limit + ' to ' + '%.1f' % host.limit + ' requests in flight')
+
+    # Returns the current limits of each host as {host: (concurrency, requests per second or None if unpaced)}
+    def get_limits(self):
+        with self.condition:
+            return dict((name, (host.limit, 1.0 / host.interval if host.interval > 0 else None)) for name, host in self.hosts.items())
+
 
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     """Retry calling the decorated function using an exponential backoff.
 
-    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
-    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
+    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
+    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
+
+    :param ExceptionToCheck: the exception to check. may be a tuple of
+        exceptions to check
+    :type ExceptionToCheck: Exception or tuple
+    :param tries: number of times to try (not retry) before giving up
+    :type tries: int
+    :param delay: initial delay between retries in seconds
+    :type delay: int
+    :param backoff: backoff multiplier e.g. value of 2 will double the delay
+        each retry
+    :type backoff: int
+    :param logger: logger to use. If None, print
+    :type logger: logging.Logger instance
+    """
+    def deco_retry(f):
+        @wraps(f)
+        def f_retry(*args, **kwargs):
+            mtries, mdelay = tries, delay
+            while mtries > 1:
+                try:
+                    return f(*args, **kwargs)
+                except ExceptionToCheck as err:
+                    msg = "%s, Retrying in %d seconds..." % (str(err), mdelay)
+                    if logger:
+                        logger.warning(msg)
+                    else:
+                        print(msg)
+                    time.sleep(mdelay)
+                    mtries -= 1
+                    mdelay *= backoff
+            return f(*args, **kwargs)
+        return f_retry  # true decorator
+    return deco_retry
+
+
+# Caches parsed entities (e.g. reviewers, hotels) on disk with an in-memory LRU front
+class EntityCache(object):
+    def __init__(self, path, ttl, capacity=10000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.lock = Lock()
+        self.memory = OrderedDict()
+        self.hits = dict()
+        self.misses = dict()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        # Entities are stored on the hot path of every run, the write-ahead log saves a sync per stored entity
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entities (kind TEXT, key TEXT, value TEXT, stored_at REAL, PRIMARY KEY (kind, key))')
+        self.connection.commit()
+
+    # Returns the cached entity or None if it is missing or expired
+    def get(self, kind, key):
+        now = time.time()
+
+        with self.lock:
+            entry = self.memory.get((kind, key))
+
+            if entry is None:
+                row = self.connection.execute('SELECT value, stored_at FROM entities WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1] + self.ttl)
+                    self.remember(kind, key, entry)
+            else:
+                self.memory.move_to_end((kind, key))
+
+            if entry is None or now > entry[1]:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return dict(entry[0])
+
+    # Stores an entity, entities with an own (short) ttl are only kept in memory (e.g. the ones of failed retrievals)
+    def put(self, kind, key, value, ttl=None):
+        stored_at = time.time()
+        entry = (dict(value), stored_at + (self.ttl if ttl is None else ttl))
+
+        with self.lock:
+            self.remember(kind, key, entry)
+
+            if ttl is None:
+                self.connection.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)', (kind, key, json.dumps(entry[0]), stored_at))
+                self.connection.commit()
+
+    # Adds an entry to the in-memory front and evicts the least recently used one
+    def remember(self, kind, key, entry):
+        self.memory[(kind, key)] = entry
+        self.memory.move_to_end((kind, key))
+
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Raised in offline mode if a response is not available in the response cache
+class CacheMissError(Exception):
+    pass
+
+
+# Raised with --adaptive if a host still throttles a request after all tries
+class ThrottledError(Exception):
+    pass
+
+
+# Stores compressed response bodies content-addressed on disk and revalidates stale ones conditionally
+class ResponseCache(object):
+    def __init__(self, path, mode, freshness):
+        self.path = path
+        self.mode = mode
+        self.freshness = freshness
+        self.lock = Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+        if not os.path.isdir(os.path.join(path, 'bodies')):
+            os.makedirs(os.path.join(path, 'bodies'))
+
+        self.connection = sqlite3.connect(os.path.join(path, 'responses.sqlite'), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, digest TEXT, etag TEXT, last_modified TEXT, fetched_at REAL)')
+        self.connection.commit()
+
+    def body_path(self, digest):
+        return os.path.join(self.path, 'bodies', digest[:2], digest + '.gz')
+
+    # Returns the index entry of an url and its body or None if the url is not cached
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute('SELECT digest, etag, last_modified, fetched_at FROM responses WHERE url = ?', (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        try:
+            with gzip.open(self.body_path(row[0]), 'rb') as body_file:
+                return row, body_file.read()
+        except (OSError, EOFError):
+            # A missing or truncated body is a cache miss
+            return None
+
+    def store(self, url, content, etag, last_modified):
+        digest = hashlib.sha1(content).hexdigest()
+        body_path = self.body_path(digest)
+
+        # Identical bodies are stored only once
+        if not os.path.isfile(body_path):
+            if not os.path.isdir(os.path.dirname(body_path)):
+                os.makedirs(os.path.dirname(body_path), exist_ok=True)
+
+            # Write to a temporary file of the thread first so that a crash never leaves a truncated body behind
+            temporary_path = body_path + '.' + str(os.getpid()) + '-' + str(get_ident()) + '.tmp'
+            with gzip.open(temporary_path, 'wb') as body_file:
+                body_file.write(content)
+
+            # Another thread may have stored the same body in the meantime
+            if os.path.isfile(body_path):
+                os.remove(temporary_path)
+            else:
+                os.replace(temporary_path, body_path)
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (url, digest, etag, last_modified, time.time()))
+            self.connection.commit()
+
+    # Marks a cached response as fresh again after a successful revalidation
+    def touch(self, url):
+        with self.lock:
+            self.connection.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+            self.connection.commit()
+
+    def get(self, url, header, stage):
+        key = transport.resolve(url) if transport is not None else urldefrag(url)[0]
+        cached = self.lookup(key)
+
+        if cached is None:
+            if self.mode == 'offline':
+                raise CacheMissError('Response of ' + key + ' is not available in the cache')
+
+            # The counters are updated by all threads of the fetch pool
+            with self.lock:
+                self.misses += 1
+
+            response = fetch_response(url, header, stage)
+
+            if self.mode == 'readwrite' and response.status_code == 200:
+                self.store(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+            return response.content
+
+        (digest, etag, last_modified, fetched_at), content = cached
+
+        # Fresh responses are served from disk, offline every cached response is fresh
+        if self.mode == 'offline' or time.time() - fetched_at <= self.freshness:
+            with self.lock:
+                self.hits += 1
+
+            return content
+
+        # Revalidate a stale response with a conditional request
+        conditional_header = dict(header)
+        if etag:
+            conditional_header['If-None-Match'] = etag
+        if last_modified:
+            conditional_header['If-Modified-Since'] = last_modified
+
+        response = fetch_response(url, conditional_header, stage)
+
+        if response.status_code == 304:
+            with self.lock:
+                self.revalidations += 1
+
+            if self.mode == 'readwrite':
+                self.touch(key)
+
+            return content
+
+        with self.lock:
+            self.misses += 1
+
+        if self.mode == 'readwrite' and response.status_code == 200:
+            self.store(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+        return response.content
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+@retry(Exception, tries=40, delay=5, backoff=2, logger=logging.getLogger('retry'))
+def fetch_with_retry(url, header, stage):
+    if transport is None:
+        return requests.get(url, headers=header)
+
+    return transport.get(url, header, stage)
+
+
+# Retrieve a response paced by the rate controller, failures and throttled responses are retried as soon as the controller allows
+def fetch_adaptively(url, header, stage):
+    tries = rate_controller.tries
+
+    for attempt in range(tries):
+        host = rate_controller.acquire(url)
+        started = time.monotonic()
+
+        try:
+            response = transport.get(url, header, stage)
+        except Exception as err:
+            rate_controller.release(host, time.monotonic() - started, failed=True)
+
+            if attempt == tries - 1:
+                raise
+
+            logging.getLogger('retry').warning('%s, Retrying when %s allows' % (str(err), host.name))
+            continue
+
+        throttled = response.status_code in [429, 503]
+        rate_controller.release(host, time.monotonic() - started, throttled=throttled, retry_after=response.headers.get('Retry-After'))
+
+        if not throttled:
+            return response
+
+        # The error page of the last try must not be parsed (and journaled) as a page without hotels or reviews
+        if attempt == tries - 1:
+            raise ThrottledError('%d for %s after %d tries' % (response.status_code, url, tries))
+
+        metrics.increment('retries_total', stage=stage)
+        logging.getLogger('retry').warning('%d for %s, Retrying when %s allows' % (response.status_code, url, host.name))
+
+
+# Retrieve a response through the rate controller if it is set up
+def fetch_response(url, header, stage):
+    if rate_controller is not None and transport is not None:
+        return fetch_adaptively(url, header, stage)
+
+    return fetch_with_retry(url, header, stage)
+
+
+def get_request_with_retry(url, header, stage='default'):
+    if response_cache is None:
+        return fetch_response(url, header, stage).content
+
+    return response_cache.get(url, header, stage)
+
+
+# A page which is retrieved once and handed to all of its consumers
+class RegisteredPage(object):
+    def __init__(self, remaining_consumers):
+        self.remaining_consumers = remaining_consumers
+        self.retrieved = Event()
+        self.content = None
+        self.error = None
+        self.documents = dict()
+
+
+# Coalesces identical in-flight requests and keeps pages (and their parsed documents) until all expected consumers got them
+class PageRegistry(object):
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.pages = OrderedDict()
+        self.fetches = 0
+        self.avoided_fetches = 0
+
+    def get(self, url, header, stage, consumers=1):
+        key = transport.resolve(url) if transport is not None else urldefrag(url)[0]
+
+        with self.lock:
+            page = self.pages.get(key)
+            retrieve = page is None
+
+            if not retrieve:
+                # Another consumer already retrieved (or is retrieving) the page
+                self.avoided_fetches += 1
+                page.remaining_consumers -= 1
+
+                if page.remaining_consumers <= 0 and page.retrieved.is_set():
+                    del self.pages[key]
+            else:
+                self.fetches += 1
+                page = RegisteredPage(consumers - 1)
+                self.pages[key] = page
+                self.evict()
+
+        # The first consumer retrieves the page, all others wait for it
+        if retrieve:
+            try:
+                page.content = get_request_with_retry(url, header, stage)
+            except Exception as err:
+                page.error = err
+
+            with self.lock:
+                if page.remaining_consumers <= 0 or page.error is not None:
+                    if self.pages.get(key) is page:
+                        del self.pages[key]
+
+            page.retrieved.set()
+        else:
+            page.retrieved.wait()
+
+        if page.error is not None:
+            raise page.error
+
+        return page
+
+    # Drops the oldest retrieved pages whose remaining consumers never showed up
+    def evict(self):
+        if len(self.pages) <= self.capacity:
+            return
+
+        for key in list(self.pages):
+            if self.pages[key].retrieved.is_set():
+                del self.pages[key]
+
+                if len(self.pages) <= self.capacity:
+                    return
+
+
+# Parse the region of a page read by a stage
+def parse_document(content, stage):
+    return BeautifulSoup(content, document_parser, parse_only=DOCUMENT_REGIONS.get(stage))
+
+
+# Parse the region of a page in the retrieving thread and measure the parsing
+def parse_document_timed(content, stage):
+    started = time.monotonic()
+    document = parse_document(content, stage)
+    metrics.observe('parse_seconds', time.monotonic() - started, stage=stage)
+
+    return document
+
+
+# Parse a page and extract information out of it (runs in the parser processes)
+def extract_content(content, parser_name, stage, extractor, extractor_arguments):
+    global document_parser
+    document_parser = parser_name
+
+    return extractor(parse_document(content, stage), *extractor_arguments)
+
+
+# Retrieve a page and extract information out of it, consumers is the number of stages which need the same page during the run
+def extract_page(url, header, stage, extractor, extractor_arguments=(), consumers=1):
+    # Without parser processes the page is parsed by the retrieving thread
+    if parser_pool is None:
+        metrics.increment('pages_extracted_total', stage=stage)
+        return extractor(get_document(url, header, stage, consumers), *extractor_arguments)
+
+    if page_registry is None:
+        content = get_request_with_retry(url, header, stage)
+    else:
+        content = page_registry.get(url, header, stage, consumers).content
+
+    # Hand the raw page over to the parser processes and wait for the extracted information
+    change_queue_depth('parse', 1)
+    started = time.monotonic()
+
+    try:
+        return parser_pool.submit(extract_content, content, document_parser, stage, extractor, extractor_arguments).result()
+    finally:
+        change_queue_depth('parse', -1)
+        metrics.observe('parse_seconds', time.monotonic() - started, stage=stage)
+        metrics.increment('pages_extracted_total', stage=stage)
+
+
+# Retrieve the parsed document of an url, consumers is the number of stages which need the same page during the run
+def get_document(url, header, stage, consumers=1):
+    if page_registry is None:
+        return parse_document_timed(get_request_with_retry(url, header, stage), stage)
+
+    page = page_registry.get(url, header, stage, consumers)
+
+    # Parse each region only once for all consumers, a whole document serves all regions
+    region = stage if DOCUMENT_REGIONS.get(stage) is not None else None
+    document = page.documents.get(None)
+
+    if document is None:
+        document = page.documents.get(region)
+
+    if document is None:
+        document = parse_document_timed(page.content, stage)
+
+        if consumers > 1 or page.remaining_consumers > 0:
+            page.documents[region] = document
+
+    return document
+
+
+# Logs the number of pages retrieved and retrievals avoided by the page registry
+def log_page_registry_statistics():
+    if page_registry is None:
+        return
+
+    logger.info('REUSED: ' + str(page_registry.fetches) + ' pages retrieved, ' + str(page_registry.avoided_fetches) + ' retrievals avoided')
+
+
+# Logs the review urls skipped as duplicates of the run or as known reviews and the growth of the review index
+def log_deduplication_statistics():
+    skipped_review_urls = int(metrics.get_total('reviews_deduplicated_total'))
+
+    if skipped_review_urls > 0 or review_index is not None:
+        logger.info('DEDUPLICATED: ' + str(skipped_review_urls) + ' review urls skipped')
+
+    if review_index is not None:
+        logger.info('INDEXED: ' + str(review_index.added) + ' review ids added, ' + str(len(review_index)) + ' known review ids')
+
+
+# Logs the hits, revalidations and misses of the response cache
+def log_response_cache_statistics():
+    if response_cache is None:
+        return
+
+    logger.info('CACHED: responses: ' + str(response_cache.hits) + ' hits, ' + str(response_cache.revalidations) + ' revalidations, ' + str(response_cache.misses) + ' misses')
+
+
+# Logs the hits and misses of the entity cache
+def log_entity_cache_statistics():
+    if entity_cache is None:
+        return
+
+    for kind in sorted(set(entity_cache.hits) | set(entity_cache.misses)):
+        logger.info('CACHED: ' + kind + ': ' + str(entity_cache.hits.get(kind, 0)) + ' hits, ' + str(entity_cache.misses.get(kind, 0)) + ' misses')
+
+
+# Logs the number of requests and transferred bytes of each stage
+def log_transfer_statistics():
+    if transport is None:
+        return
+
+    for stage, (requests_count, bytes_count) in sorted(transport.statistics.items()):
+        logger.info('TRANSFERRED: ' + stage + ': ' + str(requests_count) + ' requests, ' + str(bytes_count) + ' bytes')
+
+
+# Log the limits the rate controller settled on for each host
+def log_rate_controller_statistics():
+    if rate_controller is None:
+        return
+
+    limits = rate_controller.get_limits()
+
+    for name, host in sorted(rate_controller.hosts.items()):
+        concurrency, rate = limits[name]
+        logger.info('LIMITS: ' + name + ': ' + '%.1f' % concurrency + ' requests in flight, ' + ('%.2f requests/s' % rate if rate else 'unpaced') + ', ' + str(host.requests) + ' requests, ' + str(host.throttled) + ' throttled, ' + str(host.failures) + ' failed')
+
+
+# Worker pool shared by the cities of a batch, the next task is taken from the city which is furthest behind its weighted share
+# (stride scheduling), the tasks of a city are run in submission order
+class PriorityPool(object):
+    def __init__(self, max_workers):
+        self.queue = PriorityQueue()
+        self.lock = Lock()
+        self.sequence = 0
+        self.virtual_time = 0.0
+
+        # Pass (virtual time of the next task) and stride (inverse weight) of each city
+        self.schedules = dict()
+
+        # The city of the submitting thread
+        self.local = local()
+
+        self.workers = [Thread(target=self.work, daemon=True) for i in range(max_workers)]
+
+        for worker in self.workers:
+            worker.start()
+
+    def register(self, name, weight):
+        with self.lock:
+            self.schedules[name] = [0.0, 1.0 / weight]
+
+    # Assigns the tasks submitted by the current thread to a city
+    def enter(self, name):
+        self.local.name = name
+
+    def submit(self, function, *args):
+        future = Future()
+
+        with self.lock:
+            schedule = self.schedules.get(getattr(self.local, 'name', None))
+
+            if schedule is None:
+                priority = self.virtual_time
+            else:
+                # A city which has been idle does not get to catch up on its missed share
+                priority = max(schedule[0], self.virtual_time)
+                schedule[0] = priority + schedule[1]
+
+            self.sequence += 1
+            self.queue.put((priority, self.sequence, future, function, args))
+
+        return future
+
+    def work(self):
+        while True:
+            priority, sequence, future, function, args = self.queue.get()
+
+            if future is None:
+                return
+
+            with self.lock:
+                self.virtual_time = max(self.virtual_time, priority)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(function(*args))
+            except BaseException as err:
+                future.set_exception(err)
+
+    def shutdown(self):
+        with self.lock:
+            for worker in self.workers:
+                self.sequence += 1
+                self.queue.put((float('inf'), self.sequence, None, None, None))
+
+
+# Progress of a city of a batch
+class CityProgress(object):
+    def __init__(self, city_id, name, weight):
+        self.city_id = city_id
+        self.name = name
+        self.weight = weight
+        self.journal = None
+        self.started = None
+        self.finished = None
+        self.error = None
+
+
+# Read the cities of a batch file, each line holds a geo id, a city name and optionally a weight (default: 1)
+def read_batch_file(path):
+    cities = list()
+
+    with open(path, 'r') as batch_file:
+        for line_number, line in enumerate(batch_file, 1):
+            # Lines may be commented and the fields separated by commas or whitespace
+            fields = line.split('#')[0].replace(',', ' ').split()
+
+            if not fields:
+                continue
+
+            if len(fields) < 2:
+                raise ValueError('line ' + str(line_number) + ' of ' + path + ' has no city name: ' + line.strip())
+
+            # The weight divides the stride of the city in the shared worker pool
+            try:
+                weight = float(fields[2]) if len(fields) > 2 else 1.0
+            except ValueError:
+                weight = None
+
+            if weight is None or not weight > 0 or weight == float('inf'):
+                raise ValueError('line ' + str(line_number) + ' of ' + path + ' has no positive weight: ' + line.strip())
+
+            cities.append(CityProgress(fields[0], fields[1], weight))
+
+    return cities
+
+
+# Log the combined progress and throughput of the cities of a batch
+def log_batch_report(cities, batch_started):
+    now = time.time()
+    total_stored = 0
+    total_skipped = 0
+
+    for city in cities:
+        stored = city.journal.stored if city.journal is not None else 0
+        skipped = city.journal.skipped if city.journal is not None else 0
+        total_stored += stored
+        total_skipped += skipped
+
+        if city.started is None:
+            logger.info('BATCH: ' + city.name + ' (weight ' + str(city.weight) + '): waiting')
+            continue
+
+        duration = max((city.finished or now) - city.started, 0.001)
+        state = 'running' if city.finished is None else ('failed' if city.error is not None else 'finished')
+
+        logger.info('BATCH: ' + city.name + ' (weight ' + str(city.weight) + '): ' + state + ', ' + str(stored) + ' reviews stored, ' + str(skipped) + ' skipped, ' + '%.2f' % (stored / duration) + ' reviews/s')
+
+    duration = max(now - batch_started, 0.001)
+    number_of_requests = sum(requests_count for requests_count, bytes_count in transport.statistics.values()) if transport is not None else 0
+
+    logger.info('BATCH: total: ' + str(total_stored) + ' reviews stored, ' + str(total_skipped) + ' skipped in ' + '%.0f' % duration + ' s, ' + '%.2f' % (total_stored / duration) + ' reviews/s, ' + '%.2f' % (number_of_requests / duration) + ' requests/s')
+
+
+# Applies a function to each item on the worker pool and yields the results in input order
+def map_in_order(function, items):
+    # Without a pool every item is processed sequentially
+    if fetch_pool is None:
+        for item in items:
+            yield function(item)
+        return
+
+    # Keep a bounded window of pending futures so that huge url lists are not submitted at once
+    pending = deque()
+
+    for item in items:
+        pending.append(fetch_pool.submit(function, item))
+        change_queue_depth('fetch', 1)
+
+        if len(pending) >= fetch_window:
+            change_queue_depth('fetch', -1)
+            yield pending.popleft().result()
+
+    while pending:
+        change_queue_depth('fetch', -1)
+        yield pending.popleft().result()
+
+
+# Changes the depth of a pipeline stage
+def change_queue_depth(stage, change):
+    with queue_depths_lock:
+        queue_depths[stage] += change
+
+
+# Logs the current depths of the pipeline stages
+def log_queue_depths():
+    logger.info('QUEUES: fetch: ' + str(queue_depths['fetch']) + ', parse: ' + str(queue_depths['parse']) + ', write: ' + str(queue_depths['write']))
+
+
+# Get all pagination urls of the city (as generator)
+def parse_pagination_urls_of_city(city_default_url, city_url, offset, header):
+    # Scrape number of pages (pagination of hotels in the city) out of the city (first page)
+    number_of_pages_in_city = extract_page(city_url, header, 'city-pagination', extract_number_of_pages_in_city, consumers=2)
+
+    for i in range(0, int(number_of_pages_in_city)):
+        if i == 0:
+            # Yield the already available first page url
+            logger.info('PROCESSED: %s', city_url)
+            yield city_default_url
+        else:
+            # Each page contains 30 hotels
+            city_pagination = i * offset
+
+            # Build the current page url and yield it
+            current_city_pagination_url = tripadvisor_urls.get_city_pagination_url(city_default_url, city_pagination, '#ACCOM_OVERVIEW')
+            logger.info('PROCESSED: %s', current_city_pagination_url)
+            yield current_city_pagination_url
+
+
+# Extract the number of pages (pagination of hotels in the city) of the first city page
+def extract_number_of_pages_in_city(soup):
+    try:
+        return str(soup.find('a', attrs={'class': 'last'}).contents[0])
+    except:
+        return 1
+
+
+# Get all hotel urls of the city (as generator, each hotel is yielded as soon as it is discovered and its review count listed on the city page is added to review_counts if requested)
+def parse_hotel_urls_of_city(base_url, pagination_urls, header, review_counts=None):
+    # Remember the yielded urls to remove duplicates
+    hotel_urls = set()
+
+    # Retrieve the hotel urls of all pages concurrently
+    for page_hotels in map_in_order(partial(parse_hotels_of_page, base_url, header=header), pagination_urls):
+        for hotel_url, number_of_reviews in page_hotels:
+            if hotel_url not in hotel_urls:
+                hotel_urls.add(hotel_url)
+
+                if review_counts is not None and number_of_reviews is not None:
+                    review_counts[hotel_url] = number_of_reviews
+
+                logger.info('PROCESSED: %s', hotel_url)
+                yield hotel_url
+
+
+# Get the hotel urls and review counts listed on a single page of the city
+def parse_hotels_of_page(base_url, pagination_url, header):
+    # Build url out of base and current page url
+    city_pagination_url = base_url + pagination_url
+
+    # Retrieve the hotels of the page url
+    return extract_page(city_pagination_url, header, 'city-hotels', extract_hotels, (base_url, ))
+
+
+# Extract the hotel urls of a city page together with their review counts (None if a hotel's listing shows no count)
+def extract_hotels(soup, base_url):
+    # Initialize the list for the resulting urls and counts
+    hotels = list()
+
+    # The review count follows the hotel url in the hotel's listing entry
+    for element in soup.find_all(attrs={'class': ['property_title', 'more']}):
+        if 'property_title' in element['class']:
+            hotels.append([base_url + element['href'][1:], None])
+        elif hotels and hotels[-1][1] is None:
+            number_of_reviews = re.search(r'([\d,]+) review', element.get_text())
+
+            if number_of_reviews is not None:
+                hotels[-1][1] = int(number_of_reviews.group(1).replace(',', ''))
+
+    return [tuple(hotel) for hotel in hotels]
+
+
+# Get the hotel url together with the highest pagination value of the hotel's pages
+def parse_maximum_pagination_of_hotel(hotel_url, header, review_counts=None):
+    # Each page contains 10 reviews, the hotel page is only retrieved if the city page showed no review count
+    if review_counts and review_counts.get(hotel_url) is not None:
+        return hotel_url, max((review_counts[hotel_url] + 9) // 10, 1)
+
+    # Retrieve the highest pagination value of the page url
+    return hotel_url, extract_page(hotel_url, header, 'hotel-pagination', extract_maximum_pagination_of_hotel, consumers=2)
+
+
+# Extract the highest pagination value of a hotel page
+def extract_maximum_pagination_of_hotel(soup):
+    # Scrape the highest pagination value of a hotel's pages
+    pagination_items = soup.find_all('a', attrs={'class': 'pageNum'})
+
+    try:
+        maximum_pagination_of_hotel = int(pagination_items[-1].contents[0])
+    except:
+        maximum_pagination_of_hotel = 1
+
+    return maximum_pagination_of_hotel
+
+
+# Get all pagination urls for all given hotels (as generator)
+def parse_pagination_urls_of_hotel(hotel_urls, header, review_counts=None):
+    # Retrieve the highest pagination value of all hotels concurrently
+    maximum_paginations = map_in_order(partial(parse_maximum_pagination_of_hotel, header=header, review_counts=review_counts), hotel_urls)
+
+    for hotel_url, maximum_pagination_of_hotel in maximum_paginations:
+        # Calculate all pagination urls of the hotel
+        for i in range(0, maximum_pagination_of_hotel):
+            hotel_page_url = get_hotel_pagination_url(hotel_url, i)
+            logger.info('PROCESSED: %s', hotel_page_url)
+            yield hotel_page_url
+
+
+# Build the url of the i-th review page of a hotel
+def get_hotel_pagination_url(hotel_url, i):
+    # The first page url is already available
+    if i == 0:
+        return hotel_url + '#REVIEWS'
+
+    # Each page contains 10 reviews
+    hotel_pagination = i * 10
+
+    # Build the page url
+    return tripadvisor_urls.get_hotel_pagination_url(hotel_url, hotel_pagination, '#REVIEWS')
+
+
+# Get all review urls of all given hotels (as generator, records extracted from the listing pages are added to listing_records if requested)
+def parse_review_urls_of_hotel(base_url, pagination_urls, header, listing_records=None):
+    extract_records = listing_records is not None
+
+    # Retrieve the review urls of all hotel pagination pages concurrently
+    for page_reviews in map_in_order(partial(parse_review_urls_of_page, base_url, header=header, extract_records=extract_records), pagination_urls):
+        for review_url, listing_record in page_reviews:
+            if listing_record is not None:
+                listing_records[review_url] = listing_record
+
+            # Yield the complete review url
+            logger.info('PROCESSED: %s', review_url)
+            yield review_url
+
+
+# Get the review urls of all given hotels which are newer than the newest review stored by a previous run (as generator)
+def parse_new_review_urls_of_hotels(base_url, hotel_urls, header, listing_records=None, review_counts=None):
+    extract_records = listing_records is not None
+
+    # Walk the hotels concurrently, the pages of each hotel are walked one after another
+    for hotel_reviews in map_in_order(partial(parse_new_review_urls_of_hotel, base_url, header=header, extract_records=extract_records, review_counts=review_counts), hotel_urls):
+        for review_url, listing_record in hotel_reviews:
+            if listing_record is not None:
+                listing_records[review_url] = listing_record
+
+            # Yield the complete review url
+            logger.info('PROCESSED: %s', review_url)
+            yield review_url
+
+
+# Get the new review urls (and listing records) of a hotel, its pages are ordered newest first and walked until a known review is reached
+def parse_new_review_urls_of_hotel(base_url, hotel_url, header, extract_records=False, review_counts=None):
+    newest_review_id = review_history.get_newest_review_id(hotel_url)
+
+    # The first page provides the highest pagination value (unless it is listed on the city page) and the newest reviews
+    hotel_url, maximum_pagination_of_hotel = parse_maximum_pagination_of_hotel(hotel_url, header, review_counts)
+
+    new_reviews = list()
+
+    for i in range(0, maximum_pagination_of_hotel):
+        page_reviews = parse_review_urls_of_page(base_url, get_hotel_pagination_url(hotel_url, i), header, extract_records)
+        page_new_reviews = [review for review in page_reviews if get_review_id(review[0]) > newest_review_id]
+        new_reviews += page_new_reviews
+
+        # The following pages only hold older reviews
+        if len(page_new_reviews) < len(page_reviews):
+            break
+
+    logger.info('PROCESSED: %s#REVIEWS (%d new reviews on %d of %d pages)', hotel_url, len(new_reviews), i + 1, maximum_pagination_of_hotel)
+
+    return new_reviews
+
+
+# Get the review id out of a review url (e.g. 123456 of ShowUserReviews-g190454-d123-r123456-...)
+def get_review_id(review_url):
+    return tripadvisor_urls.parse_review_url(review_url).review_id
+
+
+# Get the geo and location id of the hotel out of a hotel or review url (e.g. g190454-d123)
+def get_hotel_location(url):
+    return tripadvisor_urls.get_hotel_location(url)
+
+
+# Newest review of each hotel stored by the previous runs, a rescrape with --since-last-run stops at it
+class ReviewHistory(object):
+    def __init__(self, path):
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hotels (location TEXT PRIMARY KEY, review_id INTEGER, session TEXT)')
+        self.connection.commit()
+
+    # Returns the id of the newest stored review of a hotel (0 if no review of the hotel is known)
+    def get_newest_review_id(self, hotel_url):
+        with self.lock:
+            row = self.connection.execute('SELECT review_id FROM hotels WHERE location = ?', (get_hotel_location(hotel_url), )).fetchone()
+
+        return 0 if row is None else row[0]
+
+    # Records the stored reviews of a session, only the newest review of each hotel is kept
+    def record_reviews(self, review_urls, session):
+        newest_review_ids = dict()
+
+        for review_url in review_urls:
+            location = get_hotel_location(review_url)
+            newest_review_ids[location] = max(get_review_id(review_url), newest_review_ids.get(location, 0))
+
+        with self.lock:
+            self.connection.executemany('INSERT INTO hotels VALUES (?, ?, ?) ON CONFLICT (location) DO UPDATE SET review_id = excluded.review_id, session = excluded.session WHERE excluded.review_id > hotels.review_id',
+                                        [(location, review_id, session) for location, review_id in newest_review_ids.items()])
+            self.connection.commit()
+
+        return len(newest_review_ids)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Ids of all reviews stored by runs with --skip-known-reviews, across sessions and cities: a sorted array of 64 bit
+# integers which is read at once at startup and an append-only log of the ids added since its last compaction
+class ReviewIndex(object):
+    def __init__(self, path, compaction_size=100000):
+        self.lock = Lock()
+        self.path = path
+        self.log_path = path + '.log'
+        self.compaction_size = compaction_size
+
+        # Review ids of the compacted index in ascending order
+        self.review_ids = self.read_review_ids(path)
+
+        # Review ids added since the last compaction (a record written partially before a crash is cut off)
+        added_review_ids = self.read_review_ids(self.log_path)
+        self.added_review_ids = set(added_review_ids)
+
+        self.log_file = open(self.log_path, 'ab')
+        self.log_file.truncate(len(added_review_ids) * added_review_ids.itemsize)
+
+        # Reviews added during this run
+        self.added = 0
+
+    # Reads a file of little endian 64 bit integers
+    @staticmethod
+    def read_review_ids(path):
+        review_ids = array('Q')
+
+        if os.path.isfile(path):
+            with open(path, 'rb') as review_ids_file:
+                review_ids.fromfile(review_ids_file, os.path.getsize(path) // review_ids.itemsize)
+
+        if sys.byteorder == 'big':
+            review_ids.byteswap()
+
+        return review_ids
+
+    # Writes an array as little endian 64 bit integers
+    @staticmethod
+    def write_review_ids(review_ids_file, review_ids):
+        if sys.byteorder == 'big':
+            review_ids = array('Q', review_ids)
+            review_ids.byteswap()
+
+        review_ids.tofile(review_ids_file)
+
+    def __len__(self):
+        return len(self.review_ids) + len(self.added_review_ids)
+
+    def __contains__(self, review_id):
+        with self.lock:
+            return review_id in self.added_review_ids or self.contains_compacted(review_id)
+
+    # Binary search in the compacted index
+    def contains_compacted(self, review_id):
+        position = bisect_left(self.review_ids, review_id)
+
+        return position < len(self.review_ids) and self.review_ids[position] == review_id
+
+    # Adds the ids of stored reviews, they are appended to the log right away
+    def add(self, review_ids):
+        with self.lock:
+            new_review_ids = sorted(set(review_id for review_id in review_ids if review_id not in self.added_review_ids and not self.contains_compacted(review_id)))
+
+            if not new_review_ids:
+                return
+
+            self.added_review_ids.update(new_review_ids)
+            self.added += len(new_review_ids)
+
+            self.write_review_ids(self.log_file, array('Q', new_review_ids))
+            self.log_file.flush()
+
+    # Merges the log into the sorted index, slices between the insertion points are copied as a whole
+    def compact(self):
+        review_ids = array('Q')
+        previous_position = 0
+
+        for review_id in sorted(self.added_review_ids):
+            position = bisect_left(self.review_ids, review_id, previous_position)
+            review_ids.extend(self.review_ids[previous_position:position])
+            review_ids.append(review_id)
+            previous_position = position
+
+        review_ids.extend(self.review_ids[previous_position:])
+
+        # The index is replaced at once, a crash leaves the previous index and the complete log
+        with open(self.path + '.tmp', 'wb') as review_ids_file:
+            self.write_review_ids(review_ids_file, review_ids)
+
+        os.replace(self.path + '.tmp', self.path)
+
+        self.review_ids = review_ids
+        self.added_review_ids = set()
+        self.log_file.truncate(0)
+
+    # Compacts the index if the log has grown too large to be read quickly at startup
+    def close(self):
+        with self.lock:
+            if len(self.added_review_ids) >= self.compaction_size:
+                self.compact()
+
+            self.log_file.close()
+
+
+# Get the review urls (and listing records) listed on a single hotel pagination page
+def parse_review_urls_of_page(base_url, pagination_url, header, extract_records=False):
+    # Retrieve the review urls (and listing records) of the hotel pagination url
+    return extract_page(pagination_url, header, 'hotel-reviews', extract_reviews_of_page, (base_url, extract_records))
+
+
+# Extract the review urls (and listing records) of a hotel pagination page
+def extract_reviews_of_page(soup, base_url, extract_records):
+    # Initialize the list for the resulting urls and records
+    reviews = list()
+
+    # Get all review containers of the current page
+    hotel_review_containers = soup.find_all('div', attrs={'class': 'basic_review'})
+
+    # Retrieve each review url of the current hotel pagination page
+    for hotel_review_container in hotel_review_containers:
+        quote = hotel_review_container.find('div', attrs={'class': 'quote'})
+
+        # Get the review url without base url
+        review_url = quote.find('a')['href'][1:]
+
+        # Build the review record out of the already downloaded container
+        listing_record = None
+        if extract_records:
+            listing_record = parse_listing_record(hotel_review_container, base_url + review_url)
+
+        # Append the complete review url to the list
+        reviews.append((base_url + review_url, listing_record))
+
+    return reviews
+
+
+# Append-only journal of the progress of a session (discovered and finished review urls, stored hotels)
+class ProgressJournal(object):
+    def __init__(self, path):
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        # The write-ahead log keeps the journal consistent if the process crashes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS reviews (url TEXT PRIMARY KEY, hotel TEXT, state INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hotels (name TEXT PRIMARY KEY, headline INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+        # Hotels stored in a previous run of the session and whether their csv file has a headline already
+        self.hotels = dict((name, bool(headline)) for name, headline in self.connection.execute('SELECT name, headline FROM hotels'))
+        self.discovery_completed = self.connection.execute('SELECT value FROM properties WHERE name = ?', ('discovery-completed', )).fetchone() is not None
+
+        # Reviews stored and skipped during this run
+        self.stored = 0
+        self.skipped = 0
+
+        # Finished reviews are acknowledged in the work queue the reviews are leased from (set up by parse_reviews_of_city)
+        self.work_queue = None
+
+    # Records a discovered review url, returns False if the review was finished already
+    def record_discovered(self, review_url):
+        with self.lock:
+            row = self.connection.execute('SELECT state FROM reviews WHERE url = ?', (review_url, )).fetchone()
+
+            if row is None:
+                self.connection.execute('INSERT INTO reviews VALUES (?, NULL, 0)', (review_url, ))
+
+        return row is None or row[0] == 0
+
+    def record_discovery_completed(self):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO properties VALUES (?, ?)', ('discovery-completed', time.strftime('%Y%m%d-%H%M%S')))
+            self.connection.commit()
+            self.discovery_completed = True
+
+    def record_hotel(self, hotel_name):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO hotels VALUES (?, 0)', (hotel_name, ))
+            self.connection.commit()
+
+    # Records a finished review (1 stored, 2 skipped), stored reviews imply a headline in the hotel's csv file
+    def record_review(self, review_url, hotel_name, stored):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO reviews VALUES (?, ?, ?)', (review_url, hotel_name, 1 if stored else 2))
+
+            if stored:
+                self.connection.execute('UPDATE hotels SET headline = 1 WHERE name = ?', (hotel_name, ))
+                self.stored += 1
+                metrics.increment('reviews_written_total', output=output_format)
+            else:
+                self.skipped += 1
+                metrics.increment('reviews_skipped_total')
+
+            self.connection.commit()
+
+        if self.work_queue is not None:
+            self.work_queue.ack('review', [review_url])
+
+    # Records a batch of finished reviews (review url, hotel name, stored) in one transaction
+    def record_reviews(self, records):
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO reviews VALUES (?, ?, ?)', [(review_url, hotel_name, 1 if stored else 2) for review_url, hotel_name, stored in records])
+            self.connection.executemany('UPDATE hotels SET headline = 1 WHERE name = ?', set((hotel_name, ) for review_url, hotel_name, stored in records if stored))
+            self.connection.commit()
+
+            stored_records = sum(1 for review_url, hotel_name, stored in records if stored)
+            self.stored += stored_records
+            self.skipped += len(records) - stored_records
+
+        metrics.increment('reviews_written_total', stored_records, output=output_format)
+        metrics.increment('reviews_skipped_total', len(records) - stored_records)
+
+        if self.work_queue is not None:
+            self.work_queue.ack('review', [review_url for review_url, hotel_name, stored in records])
+
+    # Returns the number of finished and pending reviews
+    def count_reviews(self):
+        with self.lock:
+            finished = self.connection.execute('SELECT COUNT(*) FROM reviews WHERE state > 0').fetchone()[0]
+            pending = self.connection.execute('SELECT COUNT(*) FROM reviews WHERE state = 0').fetchone()[0]
+
+        return finished, pending
+
+    # Yields the review urls of the stored reviews
+    def get_stored_review_urls(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT url FROM reviews WHERE state = 1').fetchall()
+
+        for row in rows:
+            yield row[0]
+
+    # Yields the pending review urls in the order of their discovery
+    def get_pending_review_urls(self):
+        last_rowid = 0
+
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT rowid, url FROM reviews WHERE state = 0 AND rowid > ? ORDER BY rowid LIMIT 1000', (last_rowid, )).fetchall()
+
+            if not rows:
+                return
+
+            for last_rowid, review_url in rows:
+                yield review_url
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+# Work queue of the frontier (city, hotel and review urls) shared by several worker processes through a SQLite file,
+# a leased task is invisible to the other workers until its lease expires without acknowledgement
+class WorkQueue(object):
+    QUEUED, LEASED, DONE = 0, 1, 2
+
+    def __init__(self, path, visibility_timeout=600):
+        self.visibility_timeout = visibility_timeout
+        self.owner = socket.gethostname() + ':' + str(os.getpid())
+        self.lock = Lock()
+
+        # Other workers may hold the database lock for a while
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, kind TEXT, payload TEXT, state INTEGER, owner TEXT, expires REAL, attempts INTEGER, UNIQUE (kind, payload))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (kind, state, expires)')
+
+    # Adds tasks which are not queued yet
+    def put(self, kind, payloads):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('INSERT OR IGNORE INTO tasks (kind, payload, state, attempts) VALUES (?, ?, 0, 0)', [(kind, payload) for payload in payloads])
+            self.connection.execute('COMMIT')
+
+    # Leases up to count queued tasks (or tasks whose lease expired), returns them as (task id, payload)
+    def lease(self, kind, count):
+        now = time.time()
+
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                tasks = self.connection.execute('SELECT id, payload FROM tasks WHERE kind = ? AND (state = 0 OR (state = 1 AND expires < ?)) ORDER BY id LIMIT ?', (kind, now, count)).fetchall()
+                self.connection.executemany('UPDATE tasks SET state = 1, owner = ?, expires = ?, attempts = attempts + 1 WHERE id = ?', [(self.owner, now + self.visibility_timeout, task_id) for task_id, payload in tasks])
+                self.connection.execute('COMMIT')
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return tasks
+
+    # Acknowledges finished tasks, they are never handed out again
+    def ack(self, kind, payloads):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('UPDATE tasks SET state = 2, expires = NULL WHERE kind = ? AND payload = ?', [(kind, payload) for payload in payloads])
+            self.connection.execute('COMMIT')
+
+    # Returns the number of tasks per kind and state as {kind: [queued, leased, done]}
+    def count_tasks(self):
+        counts = dict()
+
+        with self.lock:
+            for kind, state, number_of_tasks in self.connection.execute('SELECT kind, state, COUNT(*) FROM tasks GROUP BY kind, state'):
+                counts.setdefault(kind, [0, 0, 0])[state] = number_of_tasks
+
+        return counts
+
+    # Tasks which are queued, whose lease expired or which are leased and of one of the given kinds
+    def count_open_tasks(self, leased_kinds):
+        query = 'SELECT COUNT(*) FROM tasks WHERE state = 0 OR (state = 1 AND (expires < ? OR kind IN (' + ', '.join('?' * len(leased_kinds)) + ')))'
+
+        with self.lock:
+            return self.connection.execute(query, (time.time(),) + tuple(leased_kinds)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Yields the review urls leased from the work queue, the city and its hotels are discovered by whichever worker leases them
+def lease_review_urls(work_queue, base_url, city_default_url, header, listing_records=None, poll_interval=5):
+    work_queue.put('city', [city_default_url])
+
+    # Review counts of the city pages retrieved by this worker, other workers retrieve the hotel pages instead
+    review_counts = dict()
+
+    while True:
+        # Reviews first, so that discovered work is finished before more is discovered
+        review_tasks = work_queue.lease('review', fetch_window)
+
+        if review_tasks:
+            for task_id, review_url in review_tasks:
+                yield review_url
+            continue
+
+        hotel_tasks = work_queue.lease('hotel', fetch_window)
+
+        if hotel_tasks:
+            hotel_urls = [hotel_url for task_id, hotel_url in hotel_tasks]
+            review_urls = discover_review_urls_of_hotels(base_url, hotel_urls, header, listing_records, review_counts)
+
+            work_queue.put('review', list(review_urls))
+            work_queue.ack('hotel', hotel_urls)
+            continue
+
+        city_tasks = work_queue.lease('city', 1)
+
+        if city_tasks:
+            hotel_urls = parse_hotel_urls_of_city(base_url, parse_pagination_urls_of_city(city_default_url, base_url + city_default_url, 30, header), header, review_counts)
+
+            work_queue.put('hotel', list(hotel_urls))
+            work_queue.ack('city', [city_default_url])
+            continue
+
+        # Reviews leased by other workers are left to them (and taken over by any worker once their lease expired),
+        # waiting for them here would block the reviews of this worker which are still in the pipeline
+        if work_queue.count_open_tasks(('city', 'hotel')) == 0:
+            return
+
+        # Other workers are still discovering the city or its hotels
+        time.sleep(poll_interval)
+
+
+# Log the state of the tasks of the work queue
+def log_work_queue_statistics(work_queue):
+    for kind, (queued, leased, done) in sorted(work_queue.count_tasks().items()):
+        logger.info('WORK QUEUE: ' + kind + ': ' + str(done) + ' done, ' + str(leased) + ' leased, ' + str(queued) + ' queued')
+
+
+# Annotate each review url with its hotel name and whether it is the first review of the hotel
+def enumerate_review_tasks(review_urls, journal=None, listing_records=None):
+    # Hotels of a resumed session have been processed already
+    seen_hotels = set(journal.hotels) if journal is not None else set()
+
+    # Reviews handed on during this run, overlapping pagination pages may list a review twice
+    seen_review_ids = set()
+
+    for review_url in review_urls:
+        # Parse the ids and names of the review url at once
+        review = tripadvisor_urls.parse_review_url(review_url)
+        review_id = review.review_id
+
+        if review_id in seen_review_ids:
+            metrics.increment('reviews_deduplicated_total', reason='duplicate')
+            continue
+
+        # Skip the reviews stored by previous runs (across sessions and cities) without retrieving them
+        if review_index is not None and review_id in review_index:
+            metrics.increment('reviews_deduplicated_total', reason='known')
 
-    :param ExceptionToCheck: the exception to check. may be a tuple of
-        exceptions to check
-    :type ExceptionToCheck: Exception or tuple
-    :param tries: number of times to try (not retry) before giving up
-    :type tries: int
-    :param delay: initial delay between retries in seconds
-    :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    :type backoff: int
-    :param logger: logger to use. If None, print
-    :type logger: logging.Logger instance
-    """
-    def deco_retry(f):
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToCheck as err:
-                    msg = "%s, Retrying in %d seconds..." % (str(err), mdelay)
-                    if logger:
-                        logger.warning(msg)
-                    else:
-                        print(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
-        return f_retry  # true decorator
-    return deco_retry
+            if listing_records is not None:
+                listing_records.pop(review_url, None)
 
+            if journal is not None and journal.work_queue is not None:
+                journal.work_queue.ack('review', [review_url])
 
-@retry(Exception, tries=40, delay=5, backoff=2, logger=logging.getLogger('retry'))
-def get_request_with_retry(url, header):
-    return requests.get(url).content
+            continue
 
+        seen_review_ids.add(review_id)
 
-# Get all pagination urls of the city
-def parse_pagination_urls_of_city(city_default_url, city_url, offset, header):
-    # Initialize the list for the resulting urls
-    pagination_urls = list()
+        # Skip the reviews finished in a resumed session
+        if journal is not None and not journal.record_discovered(review_url):
+            if listing_records is not None:
+                listing_records.pop(review_url, None)
+
+            continue
+
+        # Get the hotel name out of the url
+        hotel_name = review.hotel_name.replace(' ', '_').lower()
+
+        # Only the first review of a hotel triggers the processing of the hotel information
+        first_of_hotel = hotel_name not in seen_hotels
+        seen_hotels.add(hotel_name)
+
+        metrics.increment('reviews_discovered_total')
+
+        yield review_url, hotel_name, first_of_hotel
 
-    # Retrieve url content of city (first page)
-    content = get_request_with_retry(city_url, header)
+    # All review urls are known now, a resumed session does not need to discover them again
+    if journal is not None:
+        journal.record_discovery_completed()
 
-    # Define parser
-    soup = BeautifulSoup(content, 'html.parser')
 
-    # Scrape number of pages (pagination of hotels in the city)
+# Retrieve hotel (if needed) and review information of a single review url
+def scrape_review(user_base_url, header, listing_records, task):
+    review_url, hotel_name, first_of_hotel = task
+    hotel_information = None
+    review_information = None
+
+    if first_of_hotel:
+        try:
+            hotel_information = get_hotel_information(review_url, header)
+        except Exception as err:
+            # The review is skipped together with its hotel, thus it is not parsed at all
+            return review_url, hotel_name, err, None
+
     try:
-        number_of_pages_in_city = soup.find('a', attrs={'class': 'last'}).contents[0]
-    except:
-        number_of_pages_in_city = 1
+        review_information = parse_review_information(review_url, user_base_url, header, listing_records.pop(review_url, None))
+    except Exception as err:
+        review_information = err
 
-    for i in range(0, int(number_of_pages_in_city)):
-        if i == 0:
-            # Append the already available first page url
-            pagination_urls.append(city_default_url)
-            logger.info('PROCESSED: ' + city_url)
-        else:
-            # Calculate the dash positions
-            occurences_of_dash = [j for j in range(len(city_default_url)) if city_default_url.startswith('-', j)]
+    return review_url, hotel_name, hotel_information, review_information
 
-            # Get the second dash position
-            second_dash_index = occurences_of_dash[1]
 
-            # Each page contains 30 hotels
-            city_pagination = i * offset
+# Chain the discovery stages of a city, each review url is handed downstream as soon as it is discovered
+def discover_review_urls(base_url, city_default_url, header, listing_records=None):
+    # Define items per page
+    number_of_hotels_per_page = 30
+
+    city_pagination_urls = parse_pagination_urls_of_city(city_default_url, base_url + city_default_url, number_of_hotels_per_page, header)
+    # The review counts listed on the city pages spare the retrieval of the hotel pages for their pagination
+    review_counts = dict()
+    city_hotel_urls = parse_hotel_urls_of_city(base_url, city_pagination_urls, header, review_counts)
 
-            # Build the current page url and append it to the list
-            current_city_pagination_url = city_default_url[:second_dash_index] + '-oa' + str(city_pagination) + city_default_url[second_dash_index:] + '#ACCOM_OVERVIEW'
-            pagination_urls.append(current_city_pagination_url)
-            logger.info('PROCESSED: ' + current_city_pagination_url)
+    return discover_review_urls_of_hotels(base_url, city_hotel_urls, header, listing_records, review_counts)
 
-    return pagination_urls
 
+# Get the review urls of the given hotels, only the reviews newer than the ones of previous runs with --since-last-run
+def discover_review_urls_of_hotels(base_url, hotel_urls, header, listing_records=None, review_counts=None):
+    if review_history is not None:
+        return parse_new_review_urls_of_hotels(base_url, hotel_urls, header, listing_records, review_counts)
 
-# Get all hotel urls of the city
-def parse_hotel_urls_of_city(base_url, pagination_urls, header):
-    # Initialize the list for the resulting urls
-    hotel_urls = list()
+    return parse_review_urls_of_hotel(base_url, parse_pagination_urls_of_hotel(hotel_urls, header, review_counts), header, listing_records)
 
-    for pagination_url in pagination_urls:
-        # Build url out of base and current page url
-        city_pagination_url = base_url + pagination_url
 
-        # Retrieve url content of the page url
-        content = get_request_with_retry(city_pagination_url, header)
+# Scrape all reviews of a city of a batch, the tasks of the city are scheduled on the shared pool according to its weight
+def scrape_city(city, base_url, user_base_url, session_timestamp, header, listing_source=False):
+    fetch_pool.enter(city.name)
+    city.started = time.time()
 
-        # Define parser
-        soup = BeautifulSoup(content, 'html.parser')
+    try:
+        city_default_url = 'Hotels-g' + city.city_id + '-' + city.name + '-Hotels.html'
+        city_listing_records = dict() if listing_source else None
 
-        # Store each hotel url in the list
-        for j, city_hotel_url in enumerate(soup.find_all('a', attrs={'class': 'property_title'})):
-            hotel_urls.append(base_url + soup.find_all('a', attrs={'class': 'property_title'})[j]['href'][1:])
-            logger.info('PROCESSED: ' + base_url + soup.find_all('a', attrs={'class': 'property_title'})[j]['href'][1:])
+        logger.info('STARTED: Scraping of ' + city.name + ' review data.')
+        parse_reviews_of_city(discover_review_urls(base_url, city_default_url, header, city_listing_records), city_default_url, user_base_url, session_timestamp, header, city_listing_records, progress=city)
+        logger.info('FINISHED: Scraping of ' + city.name + ' review data.')
+    except Exception as err:
+        city.error = err
+        logger.error('ERROR: Scraping of ' + city.name + ' failed: ' + str(err))
+    finally:
+        city.finished = time.time()
 
-    # Remove duplicates
-    hotel_urls = set(hotel_urls)
-    hotel_urls = list(hotel_urls)
 
-    return hotel_urls
+# Parse all reviews of a city
+def parse_reviews_of_city(review_urls, city_default_url, user_base_url, session_timestamp, header, listing_records=None, resume=False, progress=None, work_queue=None):
+    # Hotel names are split from the city name of the city url (instead of the part after the last dash)
+    tripadvisor_urls.register_city_url(city_default_url)
 
+    # Create a directory for the current scrapping session (or reopen the one of the resumed session)
+    city_directory_path = create_session_directory(city_default_url, session_timestamp, resume)
 
-# Get all pagination urls for all given hotels
-def parse_pagination_urls_of_hotel(hotel_urls, header):
-    # Initialize the list for the resulting urls
-    pagination_urls = list()
+    # Record the progress in a journal to be able to resume the session after a crash
+    journal = ProgressJournal(os.path.join(city_directory_path, 'journal.sqlite'))
 
-    for hotel_url in hotel_urls:
-        # Retrieve url content of the page url
-        content = get_request_with_retry(hotel_url, header)
+    # The journal counts the stored reviews of a city of a batch
+    if progress is not None:
+        progress.journal = journal
 
-        # Define parser
-        soup = BeautifulSoup(content, 'html.parser')
+    # Reviews leased from a work queue are acknowledged once they are recorded in the journal
+    journal.work_queue = work_queue
 
-        # Scrape the highest pagination value of a hotel's pages
-        pagination_items = soup.find_all('a', attrs={'class': 'pageNum'})
-        
-        try:
-            maximum_pagination_of_hotel = int(pagination_items[-1].contents[0])
-        except:
-            maximum_pagination_of_hotel = 1
+    # The number of reviews is unknown while the review urls are still discovered
+    number_of_reviews = len(review_urls) if isinstance(review_urls, (list, tripadvisor_frontier.ReviewFrontier)) else '?'
 
-        # Calculate all pagination urls of the hotel
-        for i in range(0, maximum_pagination_of_hotel):
-            if i == 0:
-                # Append the already available first page url
-                pagination_urls.append(hotel_url + '#REVIEWS')
-                logger.info('PROCESSED: ' + hotel_url + '#REVIEWS')
-            else:
-                # Calculate the dash positions
-                occurrences_of_dash = [j for j in range(len(hotel_url)) if hotel_url.startswith('-', j)]
+    if resume:
+        finished_reviews, pending_reviews = journal.count_reviews()
+
+        # Continue with the pending review urls if all of them were discovered in the resumed session
+        if journal.discovery_completed:
+            review_urls = journal.get_pending_review_urls()
+            number_of_reviews = pending_reviews
 
-                # Get the fourth dash position
-                fourth_dash_index = occurrences_of_dash[3]
+        logger.info('RESUMED: ' + str(finished_reviews) + ' reviews finished, ' + str(pending_reviews) + ' reviews left' + ('' if journal.discovery_completed else ' (review urls are still to be discovered)'))
 
-                # Each page contains 10 hotels
-                hotel_pagination = i * 10
+    # The progress reports estimate the remaining time out of the known number of reviews (or the reviews discovered so far)
+    if number_of_reviews == '?':
+        review_urls = track_discovery(review_urls)
+    else:
+        metrics.increment('reviews_expected', number_of_reviews)
 
-                # Build the current page url and append it to the list
-                hotel_page_url = hotel_url[:fourth_dash_index] + '-or' + str(hotel_pagination) + hotel_url[fourth_dash_index:] + '#REVIEWS'
-                pagination_urls.append(hotel_page_url)
-                logger.info('PROCESSED: ' + hotel_page_url)
+    # The single writer stage persists the scraped reviews in the order of the review urls
+    write_queue = Queue(maxsize=fetch_window)
 
-    return pagination_urls
+    # The writer of the chosen output format buffers the reviews and writes them in batches
+    review_writer = REVIEW_WRITERS[output_format](city_directory_path)
 
+    writer = Thread(target=store_reviews_of_city, args=(write_queue, review_writer, number_of_reviews, journal))
+    writer.start()
 
-# Get all review urls of all given hotels
-def parse_review_urls_of_hotel(base_url, pagination_urls, header):
-    # Initialize the list for the resulting urls
-    review_urls = list()
+    # Retrieve the information concurrently (parsing happens in the parser processes if configured)
+    # The listing records are filled while the review urls are discovered, an empty dict has to be passed on as it is
+    listing_records = listing_records if listing_records is not None else dict()
+    scraped_reviews = map_in_order(partial(scrape_review, user_base_url, header, listing_records), enumerate_review_tasks(review_urls, journal, listing_records))
 
-    for pagination_url in pagination_urls:
-        # Retrieve url content of the hotel pagination url
-        content = get_request_with_retry(pagination_url, header)
+    completed = False
 
-        # Define parser
-        soup = BeautifulSoup(content, 'html.parser')
+    try:
+        for scraped_review in scraped_reviews:
+            write_queue.put(scraped_review)
+            change_queue_depth('write', 1)
 
-        # Get all review containers of the current page
-        hotel_review_containers = soup.find_all('div', attrs={'class': 'basic_review'})
+        completed = True
+    finally:
+        # Signal the end of the reviews to the writer
+        write_queue.put(None)
+        writer.join()
+        review_writer.close()
 
-        # Retrieve each review url of the current hotel pagination page
-        for hotel_review_container in hotel_review_containers:
-            quote = hotel_review_container.find('div', attrs={'class': 'quote'})
+        # Only a completed session moves the newest known reviews forward, a crashed one is scraped again
+        if completed and review_history is not None:
+            number_of_hotels = review_history.record_reviews(journal.get_stored_review_urls(), session_timestamp)
+            logger.info('HISTORY: Newest reviews of ' + str(number_of_hotels) + ' hotels recorded for --since-last-run')
 
-            # Get the review url without base url
-            review_url = quote.find('a')['href'][1:]
+        journal.close()
 
-            # Append the complete review url to the list
-            review_urls.append(base_url + review_url)
-            logger.info('PROCESSED: ' + base_url + review_url)
 
-    return review_urls
+# Counts the city as discovering its review urls until all of them are handed on
+def track_discovery(review_urls):
+    metrics.increment('discoveries_running')
 
+    try:
+        for review_url in review_urls:
+            yield review_url
+    finally:
+        metrics.increment('discoveries_running', -1)
 
-# Parse all reviews of a city
-def parse_reviews_of_city(review_urls, city_default_url, user_base_url, session_timestamp, header):
-    processed_hotels = list()
-    hotel_information = dict()
 
-    # Create a directory for the current scrapping session
-    city_directory_path = create_session_directory(city_default_url, session_timestamp)
+# Store the scraped reviews of a city delivered by the write queue until None is received
+def store_reviews_of_city(write_queue, review_writer, number_of_reviews, journal):
+    # Hotels of a resumed session are reopened instead of being created
+    resumed_hotels = dict(journal.hotels)
+    processed_hotels = set()
 
-    hotel_directory_path = ''
-    rating_directory_paths = []
-    headline_exists = False
+    # Reviews handed to the writer but not written yet
+    batch = list()
 
-    for i, review_url in enumerate(review_urls):
-        logger.info('STARTED: Processing of ' + review_url + ' (Review ' + str(i + 1) + ' of ' + str(len(review_urls)) + ')')
+    # A stalled pipeline (e.g. waiting for the tasks of other workers) must not hold back the written reviews
+    def flush_idle_batch():
+        flush_reviews(review_writer, journal, batch)
+        del batch[:]
 
-        # Calculate the dash positions
-        occurrences_of_dash = [j for j in range(len(review_url)) if review_url.startswith('-', j)]
+    for i, (review_url, hotel_name, scraped_hotel_information, review_information) in enumerate(read_write_queue(write_queue, flush_idle_batch)):
+        change_queue_depth('write', -1)
 
-        # Get the hotel name out of the url
-        hotel_name = review_url[occurrences_of_dash[3] + 1:occurrences_of_dash[4]].replace(' ', '_').lower()
+        # Report the depths of the pipeline stages regularly
+        if i % 1000 == 0:
+            log_queue_depths()
+
+        logger.info('STARTED: Processing of %s (Review %d of %s)', review_url, i + 1, number_of_reviews)
 
         # Only process hotel information once
         if hotel_name not in processed_hotels:
             try:
-                headline_exists = False
-                rating_directory_paths = []
-                processed_hotels.append(hotel_name)
-                hotel_information = parse_hotel_information(review_url, header)
-                hotel_directory_path = create_hotel_directory(hotel_name, city_directory_path)
-                rating_directory_paths = create_rating_directories(hotel_directory_path)
-                store_hotel_data_in_csv(hotel_name, hotel_information, hotel_directory_path)
+                processed_hotels.add(hotel_name)
+
+                if hotel_name in resumed_hotels:
+                    # Reopen the hotel of the resumed session
+                    review_writer.reopen_hotel(hotel_name, resumed_hotels[hotel_name])
+                else:
+                    # Raise the error which occurred while retrieving the hotel information
+                    if isinstance(scraped_hotel_information, Exception):
+                        raise scraped_hotel_information
+
+                    review_writer.write_hotel(hotel_name, scraped_hotel_information)
+                    journal.record_hotel(hotel_name)
             except:
                 logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to an unexpected error!')
+                journal.record_review(review_url, hotel_name, False)
                 continue
 
-        # Parse review information
-        try:
-            review_information = parse_review_information(review_url, user_base_url, header)
-        except ValueError:
+        # Check the parsed review information
+        if isinstance(review_information, ValueError):
             logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to missing of essential information!')
+            journal.record_review(review_url, hotel_name, False)
             continue
-        except:
+        elif isinstance(review_information, ThrottledError):
+            # Left open in the journal, thus it is retrieved again by the next --resume run
+            logger.warning('WARNING: Processing of ' + review_url + ' was given up due to throttling!')
+            continue
+        elif isinstance(review_information, Exception):
             logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to an unexpected error!')
+            journal.record_review(review_url, hotel_name, False)
             continue
 
-        # Store review information in csv file
+        # Hand the review to the writer, it is written with the next batch
         try:
-            store_review_data_in_csv(review_url, hotel_name, review_information, hotel_directory_path, headline_exists)
+            review_writer.add_review(review_url, hotel_name, review_information)
         except:
             logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to an unexpected error!')
+            journal.record_review(review_url, hotel_name, False)
             continue
 
-        if not headline_exists:
-            headline_exists = True
+        batch.append((review_url, hotel_name))
+
+        if len(batch) >= write_batch_size:
+            flush_reviews(review_writer, journal, batch)
+            del batch[:]
 
-        # Store review text in textfile
+        logger.info('FINISHED: Processing of %s (Review %d of %s)', review_url, i + 1, number_of_reviews)
+
+    flush_reviews(review_writer, journal, batch)
+
+
+# Yields the reviews of the write queue until its end, idle_callback is called whenever no review arrived for a while
+def read_write_queue(write_queue, idle_callback):
+    while True:
         try:
-            store_review_data_in_txt(review_url, rating_directory_paths, review_information)
-        except:
-            logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to an unexpected error!')
-            continue		
+            item = write_queue.get(timeout=WRITE_IDLE_TIMEOUT)
+        except Empty:
+            idle_callback()
+            continue
+
+        if item is None:
+            return
+
+        yield item
+
+
+# Write a batch of reviews and record them in the journal afterwards (a crash in between repeats the batch)
+def flush_reviews(review_writer, journal, batch):
+    if not batch:
+        return
+
+    try:
+        failed_review_urls = review_writer.flush()
+    except:
+        failed_review_urls = set(review_url for review_url, hotel_name in batch)
+
+    for review_url in failed_review_urls:
+        logger.warning('WARNING: Processing of ' + review_url + ' was skipped due to an unexpected error!')
+
+    journal.record_reviews([(review_url, hotel_name, review_url not in failed_review_urls) for review_url, hotel_name in batch])
+
+    # The stored reviews are not retrieved again by later runs with --skip-known-reviews
+    if review_index is not None:
+        review_index.add(get_review_id(review_url) for review_url, hotel_name in batch if review_url not in failed_review_urls)
+
+
+# Columns of the stored reviews: headline, column name, record (0 review, 1 reviewer) and key of the record
+REVIEW_COLUMNS = [
+    ('Title', 'title', 0, 'title'), ('Text', 'text', 0, 'text'), ('Room Tip', 'room_tip', 0, 'room-tip'),
+    ('Publication Date', 'date', 0, 'date'), ('Overall Rating', 'rating', 0, 'rating'),
+    ('Value Rating', 'value_rating', 0, 'value-rating'), ('Location Rating', 'location_rating', 0, 'location-rating'),
+    ('Rooms Rating', 'rooms_rating', 0, 'rooms-rating'), ('Cleanliness Rating', 'cleanliness_rating', 0, 'cleanliness-rating'),
+    ('Service Rating', 'service_rating', 0, 'service-rating'), ('Business Rating', 'business_rating', 0, 'business-rating'),
+    ('Check-In Rating', 'check_in_rating', 0, 'check-rating'), ('Sleep Quality Rating', 'sleep_quality_rating', 0, 'sleep-rating'),
+    ('Stay', 'stay', 0, 'time'), ('Reason', 'reason', 0, 'reason'), ('Helpful Votes Count', 'helpful_votes', 0, 'helpful-votes'),
+    ('Review URL', 'url', 0, 'url'), ('Reviewer', 'reviewer', 1, 'name'), ('Level', 'reviewer_level', 1, 'level'),
+    ('Member Since', 'reviewer_since', 1, 'since'), ('Hometown', 'reviewer_hometown', 1, 'hometown'),
+    ('Demographics', 'reviewer_demographics', 1, 'demographic'), ('Review Count', 'reviewer_review_count', 1, 'reviews'),
+    ('Rating Count', 'reviewer_rating_count', 1, 'ratings'), ('Photo Count', 'reviewer_photo_count', 1, 'photos'),
+    ('Reviewer Helpful Votes Count', 'reviewer_helpful_votes', 1, 'helpfuls'), ('Reviewer Tags', 'reviewer_tags', 1, 'tags'),
+    ('Reviewer Profile URL', 'reviewer_url', 1, 'url')
+]
+
+# Columns of the stored hotels: headline, column name and key of the hotel information
+HOTEL_COLUMNS = [
+    ('Name', 'name', 'name'), ('Address', 'address', 'address'), ('Description', 'description', 'description'),
+    ('Stars', 'stars', 'stars'), ('Room Count', 'room_count', 'room-count'), ('Amenities', 'amenities', 'amenities'),
+    ('TripAdvisor City Rank', 'rank', 'rank'), ('Overall Rating', 'overall_rating', 'overall-rating'),
+    ('Review Count', 'review_count', 'review-count'), ('Review Rating Count', 'star_filter', 'star-filter'),
+    ('Review Reason Count', 'reason_filter', 'reason-filter'), ('Reviewer Languages', 'reviewer_languages', 'reviewer-languages')
+]
+
+
+# Writes the original layout: a directory per hotel with csv files and a text file per review in rating directories (or a pack of all texts)
+class CsvReviewWriter(object):
+    def __init__(self, city_directory_path):
+        self.city_directory_path = city_directory_path
+
+        # The pack replaces the rating directories
+        self.review_pack = None
+
+        if review_text_store == 'pack':
+            self.review_pack = tripadvisor_pack.ReviewPackWriter(os.path.join(city_directory_path, 'reviews-pack'))
+
+        # Directory, rating directories and headline state per hotel
+        self.hotels = dict()
+
+        # Buffered reviews per hotel in the order they were added
+        self.reviews = OrderedDict()
+
+    def write_hotel(self, hotel_name, hotel_information):
+        hotel_directory_path = create_hotel_directory(hotel_name, self.city_directory_path)
+        rating_directory_paths = create_rating_directories(hotel_directory_path) if self.review_pack is None else []
+        store_hotel_data_in_csv(hotel_name, hotel_information, hotel_directory_path)
+
+        self.hotels[hotel_name] = [hotel_directory_path, rating_directory_paths, False]
+
+    def reopen_hotel(self, hotel_name, headline_exists):
+        hotel_directory_path = os.path.join(self.city_directory_path, hotel_name)
+        rating_directory_paths = [os.path.join(hotel_directory_path, str(star) + '-star') for star in [1, 2, 3, 4, 5]]
+
+        self.hotels[hotel_name] = [hotel_directory_path, rating_directory_paths, headline_exists]
+
+    def add_review(self, review_url, hotel_name, review_information):
+        # Reviews of hotels which could not be stored are rejected
+        if hotel_name not in self.hotels:
+            raise KeyError(hotel_name)
+
+        self.reviews.setdefault(hotel_name, list()).append((review_url, review_information))
+
+    # Writes the buffered reviews with one csv open per hotel, returns the urls of the reviews which failed
+    def flush(self):
+        failed_review_urls = set()
+
+        try:
+            for hotel_name, reviews in self.reviews.items():
+                hotel_directory_path, rating_directory_paths, headline_exists = self.hotels[hotel_name]
+
+                # Store review information in csv file
+                try:
+                    store_review_data_in_csv(hotel_name, reviews, hotel_directory_path, headline_exists)
+                except:
+                    failed_review_urls.update(review_url for review_url, review_information in reviews)
+                    continue
+
+                self.hotels[hotel_name][2] = True
+
+                # Store review text in textfile or pack (a missing text does not invalidate the stored review)
+                for review_url, review_information in reviews:
+                    try:
+                        if self.review_pack is None:
+                            store_review_data_in_txt(review_url, rating_directory_paths, review_information)
+                        else:
+                            store_review_data_in_pack(review_url, hotel_name, self.review_pack, review_information)
+                    except:
+                        logger.warning('WARNING: Storing of review text from ' + review_url + ' failed due to an unexpected error!')
+
+            # All texts of the batch form one block of the pack
+            if self.review_pack is not None:
+                try:
+                    self.review_pack.flush()
+                except:
+                    logger.warning('WARNING: Storing of a block of review texts into ' + self.review_pack.directory_path.replace('\\\\?\\', '') + ' failed due to an unexpected error!')
+        finally:
+            self.reviews = OrderedDict()
+
+        return failed_review_urls
+
+    def close(self):
+        if self.review_pack is not None:
+            self.review_pack.close()
+
+
+# Writes all reviews and hotels of a session into one SQLite database (reviews.sqlite)
+class SqliteReviewWriter(object):
+    def __init__(self, city_directory_path):
+        self.connection = sqlite3.connect(os.path.join(city_directory_path, 'reviews.sqlite'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hotels (hotel TEXT PRIMARY KEY, ' + ', '.join(column + ' TEXT' for headline, column, key in HOTEL_COLUMNS) + ')')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS reviews (hotel TEXT, ' + ', '.join(column + (' INTEGER' if column == 'rating' else ' TEXT') + (' PRIMARY KEY' if column == 'url' else '') for headline, column, record, key in REVIEW_COLUMNS) + ')')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reviews_hotel ON reviews (hotel)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reviews_rating ON reviews (rating)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reviews_date ON reviews (date)')
+        self.connection.commit()
+
+        self.hotels = set()
+        self.reviews = list()
+
+    def write_hotel(self, hotel_name, hotel_information):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO hotels VALUES (?' + ', ?' * len(HOTEL_COLUMNS) + ')', [hotel_name] + [hotel_information[key] for headline, column, key in HOTEL_COLUMNS])
+
+        self.hotels.add(hotel_name)
+
+    def reopen_hotel(self, hotel_name, headline_exists):
+        self.hotels.add(hotel_name)
+
+    def add_review(self, review_url, hotel_name, review_information):
+        if hotel_name not in self.hotels:
+            raise KeyError(hotel_name)
+
+        row = [hotel_name]
+
+        for headline, column, record, key in REVIEW_COLUMNS:
+            # The overall rating is stored as number of stars to be indexable
+            if column == 'rating':
+                row.append(int(review_information[record][key].replace(' stars', '')))
+            else:
+                row.append(review_information[record][key])
+
+        self.reviews.append(row)
+
+    # Writes the buffered reviews in one transaction, a failure fails all of them
+    def flush(self):
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO reviews VALUES (?' + ', ?' * len(REVIEW_COLUMNS) + ')', self.reviews)
+        finally:
+            self.reviews = list()
+
+        return set()
+
+    def close(self):
+        self.connection.close()
+
+
+# Writes all reviews of a session as JSON lines into shards of a fixed number of reviews (reviews/reviews-00000.jsonl, ...)
+class JsonlReviewWriter(object):
+    def __init__(self, city_directory_path, shard_size=100000):
+        self.directory_path = os.path.join(city_directory_path, 'reviews')
+        self.shard_size = shard_size
+
+        if not os.path.isdir(self.directory_path):
+            os.makedirs(self.directory_path)
+
+        # Continue the last shard of a resumed session
+        shard_names = sorted(name for name in os.listdir(self.directory_path) if name.startswith('reviews-'))
+        self.shard_index = len(shard_names) - 1 if shard_names else 0
+        self.shard_count = 0
+
+        if shard_names:
+            with open(self.get_shard_path(), 'rb') as shard_file:
+                self.shard_count = sum(1 for line in shard_file)
+
+        self.hotels = set()
+        self.reviews = list()
+
+    def get_shard_path(self):
+        return os.path.join(self.directory_path, 'reviews-' + str(self.shard_index).zfill(5) + '.jsonl')
+
+    def write_hotel(self, hotel_name, hotel_information):
+        with open(os.path.join(self.directory_path, 'hotels.jsonl'), 'a', encoding='utf-8') as hotels_file:
+            hotels_file.write(json.dumps({'hotel': hotel_name, 'information': hotel_information}, ensure_ascii=False) + '\n')
+
+        self.hotels.add(hotel_name)
+
+    def reopen_hotel(self, hotel_name, headline_exists):
+        self.hotels.add(hotel_name)
+
+    def add_review(self, review_url, hotel_name, review_information):
+        if hotel_name not in self.hotels:
+            raise KeyError(hotel_name)
+
+        self.reviews.append(json.dumps({'hotel': hotel_name, 'review': review_information[0], 'reviewer': review_information[1]}, ensure_ascii=False) + '\n')
+
+    # Appends the buffered reviews with one write per shard and syncs them to disk
+    def flush(self):
+        try:
+            reviews = self.reviews
+
+            while reviews:
+                # Start the next shard if the current one is full
+                if self.shard_count >= self.shard_size:
+                    self.shard_index += 1
+                    self.shard_count = 0
+
+                lines = reviews[:self.shard_size - self.shard_count]
+                reviews = reviews[len(lines):]
+
+                with open(self.get_shard_path(), 'a', encoding='utf-8') as shard_file:
+                    shard_file.write(''.join(lines))
+                    shard_file.flush()
+                    os.fsync(shard_file.fileno())
+
+                self.shard_count += len(lines)
+        finally:
+            self.reviews = list()
+
+        return set()
+
+    def close(self):
+        pass
+
+
+# Writer implementations selectable with --output
+REVIEW_WRITERS = {
+    'csv': CsvReviewWriter,
+    'sqlite': SqliteReviewWriter,
+    'jsonl': JsonlReviewWriter
+}
 
-        logger.info('FINISHED: Processing of ' + review_url + ' (Review ' + str(i + 1) + ' of ' + str(len(review_urls)) + ')')
 
 # Creates a txt file for a hotel's reviews and stores the reviews inside
 def store_review_data_in_txt(review_url, rating_directory_paths, review_information):
     rating = int(review_information[0]['rating'].replace(' stars', ''))
     rating_path = rating_directory_paths[rating - 1]
-	
-    # Calculate the dash positions
-    occurences_of_dash = [j for j in range(len(review_url)) if review_url.startswith('-', j)]
 
-    logger.info('STARTED: Storing of review text from ' + review_url + ' into ' + rating_path.replace('\\\\?\\', '') + '\\review_' + review_url[occurences_of_dash[0] + 1:occurences_of_dash[3]] + '.txt')
-	
-    # Write review text to file
-    with open(rating_path + '\\review_' + review_url[occurences_of_dash[0] + 1:occurences_of_dash[3]] + '.txt', 'wb') as file:
-        file.write(bytes(review_information[0]['text'], encoding='ascii', errors='ignore'))
+    # Build the file name once for the file and the log
+    file_path = os.path.join(rating_path, 'review_' + tripadvisor_urls.get_review_key(tripadvisor_urls.parse_review_url(review_url)) + '.txt')
+    log_path = LogPath(file_path)
 
-    logger.info('FINISHED: Storing of review text from ' + review_url + ' into ' + rating_path.replace('\\\\?\\', '') + '\\review_' + review_url[occurences_of_dash[0] + 1:occurences_of_dash[3]] + '.txt')
+    logger.info('STARTED: Storing of review text from %s into %s', review_url, log_path)
 
-# Creates a csv file for a hotel's reviews and stores the reviews inside
-def store_review_data_in_csv(review_url, hotel_name, review_data, hotel_directory_path, headline_exists):
-    logger.info('STARTED: Storing of review data from ' + review_url + ' into ' + hotel_directory_path.replace('\\\\?\\', '') + '\\' + hotel_name + '-reviews.csv')
+    # Write review text to file (UTF-8 keeps non-ASCII characters)
+    with open(file_path, 'wb') as file:
+        file.write(review_information[0]['text'].encode('utf-8'))
 
-    with open(hotel_directory_path + '\\' + hotel_name + '-reviews.csv', 'a') as file:
+    logger.info('FINISHED: Storing of review text from %s into %s', review_url, log_path)
+
+# Adds a review text to the pack of the session, it is written with the next block
+def store_review_data_in_pack(review_url, hotel_name, review_pack, review_information):
+    rating = int(review_information[0]['rating'].replace(' stars', ''))
+    review_id = get_review_id(review_url)
+
+    review_pack.add(review_id, hotel_name, rating, review_information[0]['text'])
+
+# Creates a csv file for a hotel's reviews and stores a batch of its reviews inside
+def store_review_data_in_csv(hotel_name, reviews, hotel_directory_path, headline_exists):
+    file_path = os.path.join(hotel_directory_path, hotel_name + '-reviews.csv')
+    log_path = LogPath(file_path)
+
+    logger.info('STARTED: Storing of %d reviews into %s', len(reviews), log_path)
+
+    with open(file_path, 'a') as file:
         # Setup a writer
         csvwriter = csv.writer(file, delimiter='|', dialect='excel')
 
         # Write headlines into the file
         if not headline_exists:
-            # Write headlines into the file
-            csvwriter.writerow(
-                [
-                    'Title', 'Text', 'Room Tip', 'Publication Date',
-                    'Overall Rating', 'Value Rating', 'Location Rating',
-                    'Rooms Rating', 'Cleanliness Rating', 'Service Rating',
-                    'Business Rating', 'Check-In Rating', 'Sleep Quality Rating',
-                    'Stay', 'Reason', 'Helpful Votes Count', 'Review URL', 'Reviewer', 'Level', 'Member Since',
-                    'Hometown', 'Demographics', 'Review Count', 'Rating Count', 'Photo Count',
-                    'Reviewer Helpful Votes Count', 'Reviewer Tags', 'Reviewer Profile URL'
-                ]
-            )
+            csvwriter.writerow([headline for headline, column, record, key in REVIEW_COLUMNS])
 
         # Write the data into the file
-        csvwriter.writerow(
-            [
-                review_data[0]['title'], review_data[0]['text'], review_data[0]['room-tip'], review_data[0]['date'],
-                review_data[0]['rating'], review_data[0]['value-rating'], review_data[0]['location-rating'],
-                review_data[0]['rooms-rating'], review_data[0]['cleanliness-rating'], review_data[0]['service-rating'],
-                review_data[0]['business-rating'], review_data[0]['check-rating'], review_data[0]['sleep-rating'],
-                review_data[0]['time'], review_data[0]['reason'], review_data[0]['helpful-votes'],
-                review_data[0]['url'], review_data[1]['name'], review_data[1]['level'], review_data[1]['since'],
-                review_data[1]['hometown'], review_data[1]['demographic'], review_data[1]['reviews'],
-                review_data[1]['ratings'], review_data[1]['photos'], review_data[1]['helpfuls'], review_data[1]['tags'],
-                review_data[1]['url']
-            ]
-        )
-
-    logger.info('FINISHED: Storing of review data from ' + review_url + ' into ' + hotel_directory_path.replace('\\\\?\\', '') + '\\' + hotel_name + '-reviews.csv')
+        csvwriter.writerows([review_data[record][key] for headline, column, record, key in REVIEW_COLUMNS] for review_url, review_data in reviews)
+
+    logger.info('FINISHED: Storing of %d reviews into %s', len(reviews), log_path)
 
 # Creates a csv file for a hotel and stores the hotel information inside
 def store_hotel_data_in_csv(hotel_name, hotel_data, hotel_directory_path):
-    logger.info('STARTED: Storing of hotel data ' + hotel_name + ' into ' + hotel_directory_path.replace('\\\\?\\', '') + '\\' + hotel_name + '-information.csv')
+    file_path = os.path.join(hotel_directory_path, hotel_name + '-information.csv')
+    log_path = LogPath(file_path)
+
+    logger.info('STARTED: Storing of hotel data %s into %s', hotel_name, log_path)
 
-    with open(hotel_directory_path + '\\' + hotel_name + '-information.csv', 'w') as csvfile:
+    with open(file_path, 'w') as csvfile:
         # Setup a writer
         csvwriter = csv.writer(csvfile, delimiter='|', dialect='excel')
 
         # Write headlines into the file
-        csvwriter.writerow(['Name', 'Address', 'Description', 'Stars', 'Room Count', 'Amenities', 'TripAdvisor City Rank', 'Overall Rating' , 'Review Count', 'Review Rating Count', 'Review Reason Count', 'Reviewer Languages'])
+        csvwriter.writerow([headline for headline, column, key in HOTEL_COLUMNS])
 
         # Write the data into the file
-        csvwriter.writerow(
-            [
-                hotel_data['name'], hotel_data['address'], hotel_data['description'], hotel_data['stars'], hotel_data['room-count'],
-                hotel_data['amenities'], hotel_data['rank'], hotel_data['overall-rating'], hotel_data['review-count'],
-                hotel_data['star-filter'], hotel_data['reason-filter'], hotel_data['reviewer-languages']
-            ]
-        )
+        csvwriter.writerow([hotel_data[key] for headline, column, key in HOTEL_COLUMNS])
 
-    logger.info('FINISHED: Storing of ' + hotel_name + ' into ' + hotel_directory_path.replace('\\\\?\\', '') + '\\' + hotel_name + '-information.csv')
+    logger.info('FINISHED: Storing of %s into %s', hotel_name, log_path)
 
 # Creates a directory for each rating category (e.g. 5 stars, 4 stars)
 def create_rating_directories(hotel_path):
@@ -343,14 +2500,14 @@ def create_rating_directories(hotel_path):
 
     for star in stars:
         # Build directory name
-        directory_path = hotel_path + '\\' + str(star) + '-star'
+        directory_path = os.path.join(hotel_path, str(star) + '-star')
 
-        logger.info('STARTED: Creation of directory ' + hotel_path.replace('\\\\?\\', '') + '\\' + str(star) + '-star')
+        logger.info('STARTED: Creation of directory %s', LogPath(directory_path))
 
         # Create the folder
         os.makedirs(directory_path)
 
-        logger.info('FINISHED: Creation of directory ' + hotel_path.replace('\\\\?\\', '') + '\\' + str(star) + '-star')
+        logger.info('FINISHED: Creation of directory %s', LogPath(directory_path))
 
         paths.append(directory_path)
 
@@ -359,47 +2516,60 @@ def create_rating_directories(hotel_path):
 # Creates a directory for a hotel
 def create_hotel_directory(hotel_name, city_directory_name):
     # Build directory name
-    directory_path = city_directory_name + '\\' + hotel_name
+    directory_path = os.path.join(city_directory_name, hotel_name)
 
-    logger.info('STARTED: Creation of directory ' + city_directory_name.replace('\\\\?\\', '') + '\\' + hotel_name)
+    logger.info('STARTED: Creation of directory %s', LogPath(directory_path))
 
     # Create the folder
     os.makedirs(directory_path)
 
-    logger.info('FINISHED: Creation of directory ' + city_directory_name.replace('\\\\?\\', '') + '\\' + hotel_name)
+    logger.info('FINISHED: Creation of directory %s', LogPath(directory_path))
 
     return directory_path
 
-# Creates a directory for a session
-def create_session_directory(city_default_url, session_timestamp):
+# Creates a directory for a session (or only builds its name if the session is resumed)
+def create_session_directory(city_default_url, session_timestamp, resume=False):
     # Get the city name from the url
-    occurrences_of_dash = [j for j in range(len(city_default_url)) if city_default_url.startswith('-', j)]
-    city_name = city_default_url[occurrences_of_dash[1] + 1:occurrences_of_dash[2]].lower()
+    city_name = tripadvisor_urls.parse_city_url(city_default_url).city_name.lower()
 
-    # Build directory name
-    directory_path = '\\\\?\\' + os.getcwd() + '\\data\\' + session_timestamp + '-' + city_name
+    # Build directory name (long paths are only supported with the \\?\ prefix on Windows)
+    directory_path = os.path.join(os.getcwd(), 'data', session_timestamp + '-' + city_name)
+
+    if os.name == 'nt':
+        directory_path = '\\\\?\\' + directory_path
+
+    # The directory of a resumed session has to exist already
+    if resume:
+        if not os.path.isdir(directory_path):
+            raise IOError('Directory of the resumed session ' + directory_path + ' does not exist')
+
+        return directory_path
 
-    logger.info('STARTED: Creation of directory ' + os.getcwd() + '\\data\\' + session_timestamp + '-' + city_name)
+    logger.info('STARTED: Creation of directory ' + os.path.join(os.getcwd(), 'data', session_timestamp + '-' + city_name))
 
     # Create the folder
     os.makedirs(directory_path)
 
-    logger.info('FINISHED: Creation of directory ' + os.getcwd() + '\\data\\' + session_timestamp + '-' + city_name)
+    logger.info('FINISHED: Creation of directory ' + os.path.join(os.getcwd(), 'data', session_timestamp + '-' + city_name))
 
     return directory_path
 
 
 def parse_hotel_information(review_url, header):
-    # Initialize the dictionary for the hotel
-    hotel = dict()
+    logger.info('STARTED: Parsing of hotel data from %s', review_url)
+
+    # Retrieve the hotel information of the review url
+    hotel = extract_page(review_url, header, 'hotel-information', extract_hotel_information, consumers=2)
+
+    logger.info('FINISHED: Parsing of hotel data from %s', review_url)
 
-    # Retrieve url content of the review url
-    content = get_request_with_retry(review_url, header)
+    return hotel
 
-    # Define parser
-    soup = BeautifulSoup(content, 'html.parser')
 
-    logger.info('STARTED: Parsing of hotel data from ' + review_url)
+# Extract the hotel information of a review page
+def extract_hotel_information(soup):
+    # Initialize the dictionary for the hotel
+    hotel = dict()
 
     hotel['name'] = soup.find('a', attrs={'class': 'HEADING'}).text.replace('|', '').strip()
     hotel['overall-rating'] = soup.find('img', attrs={'class': 'sprite-rating_no_fill'})['alt'][0:1] + ' stars'
@@ -473,27 +2643,71 @@ def parse_hotel_information(review_url, header):
     except:
         hotel['description'] = 'n.a.'
 
-    logger.info('FINISHED: Parsing of hotel data from ' + review_url)
+    return hotel
+
+
+# Caches an entity, one without any information parsed from its page (e.g. of an error page) is only kept for FAILED_ENTITY_TTL in memory
+def put_entity(kind, key, entity, known_fields):
+    if any(value not in ['n.a.', 'n.a'] for field, value in entity.items() if field not in known_fields):
+        entity_cache.put(kind, key, entity)
+    else:
+        entity_cache.put(kind, key, entity, FAILED_ENTITY_TTL)
+
+
+# Get the hotel information of a review from the entity cache or parse it
+def get_hotel_information(review_url, header):
+    if entity_cache is None:
+        return parse_hotel_information(review_url, header)
+
+    # The hotel id is part of each review url (e.g. -d123456-)
+    hotel_id = str(tripadvisor_urls.parse_review_url(review_url).hotel_id)
+
+    hotel = entity_cache.get('hotel', hotel_id)
+
+    if hotel is None:
+        hotel = parse_hotel_information(review_url, header)
+        put_entity('hotel', hotel_id, hotel, ['name'])
 
     return hotel
 
 
 # Parse all information of a review
-def parse_review_information(review_url, user_base_url, header):
-    # Initialize the dictionary for the review
-    review = dict()
+def parse_review_information(review_url, user_base_url, header, listing_record=None):
+    logger.info('STARTED: Parsing of review data from %s', review_url)
+
+    if listing_record is not None:
+        # Use the record already extracted from the hotel review listing page
+        review, user_name = listing_record
+        review = dict(review)
+    else:
+        try:
+            # Retrieve the review information of the review url
+            review, user_name = extract_page(review_url, header, 'review-information', extract_review_information, (review_url, ))
+        except ValueError:
+            logger.warning('WARNING: Essential review information such as title or rating is missing!')
+            raise
+
+    # Parse user information
+    reviewer = get_reviewer_information(user_name, user_base_url, header)
 
-    logger.info('STARTED: Parsing of review data from ' + review_url)
+    logger.info('FINISHED: Parsing of review data from %s', review_url)
 
-    # Retrieve url content of the review url
-    content = get_request_with_retry(review_url, header)
+    return [review, reviewer]
 
-    # Define parser
-    soup = BeautifulSoup(content, 'html.parser')
 
+# Extract the review information and the user name of a review page
+def extract_review_information(soup, review_url):
     # Parse the container which contains the whole review content and meta information
     review_container = soup.find('div', attrs={'class': 'reviewSelector'})
 
+    return parse_review_container(review_container, review_url)
+
+
+# Parse the review information and the user name of a review container (permalink page or listing page)
+def parse_review_container(review_container, review_url):
+    # Initialize the dictionary for the review
+    review = dict()
+
     # Parse the container which contains the user information
     user_container = review_container.find('div', attrs={'class': 'col1of2'})
 
@@ -506,10 +2720,9 @@ def parse_review_information(review_url, user_base_url, header):
     try:
         review['title'] = entry_container.find('div', attrs={'class': 'quote'}).text.strip().replace('“', '').replace('”', '').replace('|', '')
         review['rating'] = entry_container.find('img', attrs={'class': 'sprite-rating_s_fill'})['alt'][0:1] + ' stars'
-        review['date'] = entry_container.find('span', attrs={'class': 'ratingDate'})['content']
+        review['date'] = parse_review_date(entry_container.find('span', attrs={'class': 'ratingDate'}))
         review['text'] = entry_container.find('div', attrs={'class': 'entry'}).find('p').text.replace('\n', ' ').replace('\r', '').replace('\t', '').replace('|', '').strip()
     except:
-        logger.warning('WARNING: Essential review information such as title or rating is missing!')
         raise ValueError('Essential review information such as title or rating is missing!')
 
     try:
@@ -579,30 +2792,71 @@ def parse_review_information(review_url, user_base_url, header):
         review['check-rating'] = 'n.a.'
         review['sleep-rating'] = 'n.a.'
 
-    # Parse user information
+    # Parse user name
     user_name = user_container.find('div', attrs={'class': 'username'}).find('span', attrs={'class': 'scrname'}).text
-    reviewer = parse_reviewer_information(user_name, user_base_url, header)
 
-    logger.info('FINISHED: Parsing of review data from ' + review_url)
+    return review, user_name
 
-    return [review, reviewer]
+
+# Parse the publication date of a review (e.g. 2016-06-01)
+def parse_review_date(rating_date):
+    # Permalink pages contain the date in machine readable form
+    if rating_date.has_attr('content'):
+        return rating_date['content']
+
+    # Listing pages contain the date only as text (e.g. "Reviewed June 1, 2016"), for recent reviews in the title
+    date_text = rating_date.get('title') or rating_date.text.replace('Reviewed', '')
+
+    return time.strftime('%Y-%m-%d', time.strptime(date_text.strip(), '%B %d, %Y'))
+
+
+# Build the review record of a listing page container, None if the permalink is needed for missing information
+def parse_listing_record(review_container, review_url):
+    entry = review_container.find('div', attrs={'class': 'entry'})
+
+    # A truncated text (expandable by a "More" link) is only available completely on the permalink page
+    if entry is None or entry.find('span', attrs={'class': ['ulBlueLinks', 'moreLink']}) is not None:
+        return None
+
+    try:
+        return parse_review_container(review_container, review_url)
+    except:
+        return None
+
+
+# Get the profile information of a reviewer from the entity cache or parse it
+def get_reviewer_information(user_name, user_base_url, header):
+    if entity_cache is None:
+        return parse_reviewer_information(user_name, user_base_url, header)
+
+    user = entity_cache.get('reviewer', user_name)
+
+    if user is None:
+        user = parse_reviewer_information(user_name, user_base_url, header)
+        put_entity('reviewer', user_name, user, ['url', 'name'])
+
+    return user
 
 
 # Parse the profile information of a reviewer
 def parse_reviewer_information(user_name, user_base_url, header):
-    # Initialize the dictionary for the user
-    user = dict()
-
     # Define the user profile url
     profile_url = user_base_url + user_name
 
-    logger.info('STARTED: Parsing of user data from ' + profile_url)
+    logger.info('STARTED: Parsing of user data from %s', profile_url)
+
+    # Retrieve the profile information of the user url
+    user = extract_page(profile_url, header, 'reviewer-information', extract_reviewer_information, (user_name, profile_url))
+
+    logger.info('FINISHED: Parsing of user data from %s', profile_url)
+
+    return user
 
-    # Retrieve url content of the user url
-    content = get_request_with_retry(profile_url, header)
 
-    # Define parser
-    soup = BeautifulSoup(content, 'html.parser')
+# Extract the profile information of a reviewer page
+def extract_reviewer_information(soup, user_name, profile_url):
+    # Initialize the dictionary for the user
+    user = dict()
 
     try:
         user['url'] = profile_url
@@ -675,8 +2929,6 @@ def parse_reviewer_information(user_name, user_base_url, header):
     except:
         user['tags'] = 'n.a.'
 
-    logger.info('FINISHED: Parsing of user data from ' + profile_url)
-
     return user
 
 
@@ -684,64 +2936,268 @@ def parse_reviewer_information(user_name, user_base_url, header):
 if __name__ == '__main__':
     # Setup commandline handler
     parser = argparse.ArgumentParser(description='scrape the reviews of a whole city on tripadvisor' , usage='python tripadvisor-scrapper 60763 New_York_City_New_York')
-    parser.add_argument('id', help='the geolocation id of the city')
-    parser.add_argument('name', help='the name of the city')
-    parser.add_argument('--pickle', choices=['load', 'store'], help='[load] store a scraped reviews list as pickle for later parsing,[load] load a scraped reviews list for parsing')
-    parser.add_argument('--filename', help='the filename of the pickle file placed in pickle directory')
+    parser.add_argument('id', nargs='?', help='the geolocation id of the city')
+    parser.add_argument('name', nargs='?', help='the name of the city')
+    parser.add_argument('--batch', metavar='FILE', help='scrape all cities of a file (a geo id, city name and optional weight per line) on one shared worker pool instead of a single city')
+    parser.add_argument('--skip-known-reviews', action='store_true', help='skip the reviews stored by previous runs with this option in any session or city without retrieving them (recorded in cache/review-index)')
+    parser.add_argument('--since-last-run', action='store_true', help='only store the reviews newer than the newest review of each hotel stored by previous runs with this option (recorded in cache/review-history.sqlite)')
+    parser.add_argument('--queue', metavar='FILE', help='scrape the city as one of several workers sharing the work queue FILE (e.g. on a shared file system), each worker stores its reviews in an own session directory')
+    parser.add_argument('--visibility-timeout', type=int, default=600, help='the seconds a task leased from the work queue is hidden from other workers before it is handed out again (default: 600)')
+    parser.add_argument('--report-interval', type=int, default=60, help='the seconds between the progress reports (default: 60)')
+    parser.add_argument('--metrics-file', metavar='FILE', help='write the metrics of the run in the Prometheus text format into FILE every --report-interval seconds')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='[text] log lines, [json] JSON lines with event kind, message and arguments as fields (default: text)')
+    parser.add_argument('--log-sample', type=int, default=1, help='log one of every N per-url STARTED/FINISHED/PROCESSED events of each kind, all of them are counted in ROLLUP lines (default: 1)')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics of the run in the Prometheus text format at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--pickle', choices=['load', 'store'], help='[store] store a scraped reviews list as frontier file for later parsing, [load] load a scraped reviews list (frontier or pickle file) for parsing')
+    parser.add_argument('--filename', help='the filename of the frontier (or pickle) file placed in pickle directory')
+    parser.add_argument('--resume', metavar='SESSION', help='resume the session (e.g. 20160716-202314-vienna) in the data directory, finished reviews are skipped')
+    parser.add_argument('--base-url', default='https://www.tripadvisor.com/', help='the base url of the scraped site (default: https://www.tripadvisor.com/)')
+    parser.add_argument('--concurrency', type=int, default=1, help='the number of pages retrieved concurrently by all scraping stages (default: 1)')
+    parser.add_argument('--review-source', choices=['permalink', 'listing'], default='permalink', help='[permalink] parse each review from its own page, [listing] parse reviews from the already retrieved hotel review pages and only retrieve permalinks for missing information (default: permalink)')
+    parser.add_argument('--parser', choices=['lxml', 'html.parser'], default=DEFAULT_PARSER, help='the parser backend of all pages (default: lxml if installed, otherwise html.parser)')
+    parser.add_argument('--parser-processes', type=int, default=0, help='the number of processes parsing the retrieved pages, 0 parses in the retrieving threads (default: 0)')
+    parser.add_argument('--adaptive', action='store_true', help='adjust the requests in flight (up to --concurrency) and the request rate per host to latency, 429/503 responses and timeouts')
+    parser.add_argument('--adaptive-floor', type=int, default=1, help='the minimum number of requests in flight per host with --adaptive (default: 1)')
+    parser.add_argument('--min-rate', type=float, default=0.2, help='the lowest request rate per second per host --adaptive backs off to (default: 0.2)')
+    parser.add_argument('--max-rate', type=float, default=0, help='the highest request rate per second per host with --adaptive, 0 is unlimited (default: 0)')
+    parser.add_argument('--adaptive-tries', type=int, default=40, help='the tries of a throttled or failed request with --adaptive before it is given up, at --min-rate 0.2 40 tries last about 3 minutes (default: 40)')
+    parser.add_argument('--request-timeout', type=float, default=60, help='the seconds to wait for a response before the request fails (default: 60)')
+    parser.add_argument('--cache-mode', choices=['off', 'read', 'readwrite', 'offline'], default='off', help='[off] never use the response cache, [read] only read from it, [readwrite] read from and write to it, [offline] only use cached responses (default: off)')
+    parser.add_argument('--cache-freshness', type=int, default=24 * 60 * 60, help='the seconds a cached response is used without revalidation (default: 86400)')
+    parser.add_argument('--output', choices=['csv', 'sqlite', 'jsonl'], default='csv', help='[csv] a directory per hotel with csv files and a text file per review, [sqlite] one indexed reviews.sqlite per session, [jsonl] sharded JSON lines files per session (default: csv)')
+    parser.add_argument('--review-texts', choices=['files', 'pack'], default='files', help='[files] a text file per review in rating directories, [pack] one compressed and indexed pack of all texts per session (default: files)')
+    parser.add_argument('--write-batch-size', type=int, default=100, help='the number of reviews buffered and written at once (default: 100)')
+    parser.add_argument('--entity-ttl', type=int, default=7 * 24 * 60 * 60, help='the seconds parsed reviewers and hotels are reused from the cache, 0 disables the cache (default: 604800)')
     args = parser.parse_args()
 
+    if args.batch and (args.pickle or args.resume):
+        parser.error('--batch can not be combined with --pickle or --resume')
+    elif args.queue and (args.batch or args.pickle or args.resume):
+        parser.error('--queue can not be combined with --batch, --pickle or --resume')
+    elif not args.batch and (args.id is None or args.name is None):
+        parser.error('the geolocation id and the name of the city are required without --batch')
+
     # Setup logger
     session_timestamp = time.strftime('%Y%m%d-%H%M%S')
-    logging.basicConfig(filename='./logs/' + session_timestamp + '-' + args.name.lower() + '.log', level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_name = args.name.lower() if not args.batch else 'batch-' + os.path.splitext(os.path.basename(args.batch))[0].lower()
+    log_file_handler = logging.FileHandler('./logs/' + session_timestamp + '-' + log_name + ('.jsonl' if args.log_format == 'json' else '.log'), encoding='utf-8')
+    log_file_handler.setFormatter(JsonLinesFormatter() if args.log_format == 'json' else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    # The file and the console are written by a background thread, the scraping threads only sample and enqueue the records
+    log_queue = Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, logging.StreamHandler())
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    log_sampling.rate = max(args.log_sample, 1)
+    log_handler = BackgroundQueueHandler(log_queue)
+    log_handler.addFilter(log_sampling)
+    logging.getLogger().addHandler(log_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
     logger = logging.getLogger(__name__)
-    logging.getLogger().addHandler(logging.StreamHandler())
+
+    # A resumed session keeps the timestamp of its directory (the log of this run gets an own file)
+    if args.resume:
+        session_timestamp = args.resume[:15]
+
+    # Setup the parser backend of all pages
+    document_parser = args.parser
+
+    # Setup the output of the reviews
+    output_format = args.output
+    write_batch_size = max(args.write_batch_size, 1)
+    review_text_store = args.review_texts
+
+    # Setup the worker pool shared by all scraping stages (and all cities of a batch)
+    if args.batch:
+        fetch_pool = PriorityPool(max(args.concurrency, 1))
+        fetch_window = max(args.concurrency, 1) * 2
+    elif args.concurrency > 1:
+        fetch_pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        fetch_window = args.concurrency * 2
 
     # Define user agent
     headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.11; rv:47.0) Gecko/20100101 Firefox/47.0'}
 
-    # Define base urls of TripAdvisor
-    BASE_URL = 'http://www.tripadvisor.com/'
-    CITY_DEFAULT_URL = 'Hotels-g' + args.id + '-' + args.name + '-Hotels.html'
-    CITY_URL = BASE_URL + CITY_DEFAULT_URL
-    USER_BASE_URL = 'https://www.tripadvisor.com/members/'
+    # Setup the processes which parse the retrieved pages
+    if args.parser_processes > 0:
+        parser_pool = ProcessPoolExecutor(max_workers=args.parser_processes)
 
-    # Define items per page
-    number_of_hotels_per_page = 30
-    number_of_reviews_per_page = 10
+    # Setup the HTTP transport shared by all scraping stages
+    transport = Transport(headers, args.concurrency, args.request_timeout)
+
+    # Setup the controller of the request rate and concurrency per host
+    if args.adaptive:
+        rate_controller = RateController(args.adaptive_floor, args.concurrency, args.min_rate, args.max_rate, args.adaptive_tries)
+
+    # Setup the cache of reviewers and hotels shared by all cities and sessions
+    if args.entity_ttl > 0:
+        entity_cache = EntityCache('cache/entities.sqlite', args.entity_ttl)
+
+    # Setup the history of the newest stored review of each hotel
+    if args.since_last_run:
+        review_history = ReviewHistory('cache/review-history.sqlite')
 
-    # Parse all needed urls
-    if not args.pickle or args.pickle == 'store':
+    # Setup the index of the ids of all stored reviews
+    if args.skip_known_reviews:
+        review_index = ReviewIndex('cache/review-index')
+        logger.info('LOADED: ' + str(len(review_index)) + ' known review ids from cache/review-index')
+
+    # Setup the cache of raw responses
+    if args.cache_mode != 'off':
+        response_cache = ResponseCache('cache/responses', args.cache_mode, args.cache_freshness)
+
+    # Setup the registry which retrieves each page only once during the run
+    page_registry = PageRegistry()
+
+    # Expose the metrics of the run and report its progress regularly
+    if args.metrics_port:
+        metrics_server = ThreadingHTTPServer(('127.0.0.1', args.metrics_port), MetricsRequestHandler)
+        Thread(target=metrics_server.serve_forever, daemon=True).start()
+
+    metrics_stop = Event()
+    Thread(target=report_metrics, args=(metrics_stop, args.report_interval, args.metrics_file), daemon=True).start()
+
+    # Define base urls of TripAdvisor (or of a stand-in site, e.g. the one of tripadvisor-benchmark.py)
+    BASE_URL = args.base_url.rstrip('/') + '/'
+    USER_BASE_URL = BASE_URL + 'members/'
+
+    if not args.batch:
+        CITY_DEFAULT_URL = 'Hotels-g' + args.id + '-' + args.name + '-Hotels.html'
+
+    if args.batch:
+        try:
+            cities = read_batch_file(args.batch)
+        except ValueError as err:
+            parser.error(str(err))
+
+        logger.info('STARTED: Scraping of ' + str(len(cities)) + ' cities of ' + args.batch)
+
+        # Each city is driven by an own thread, all of them share the worker pool according to their weights
+        for city in cities:
+            fetch_pool.register(city.name, city.weight)
+
+        city_threads = [Thread(target=scrape_city, args=(city, BASE_URL, USER_BASE_URL, session_timestamp, headers, args.review_source == 'listing')) for city in cities]
+        batch_started = time.time()
+
+        for city_thread in city_threads:
+            city_thread.start()
+
+        # Report the progress regularly until all cities are finished
+        for city_thread in city_threads:
+            while city_thread.is_alive():
+                city_thread.join(args.report_interval)
+
+                if city_thread.is_alive():
+                    log_batch_report(cities, batch_started)
+
+        fetch_pool.shutdown()
+
+        logger.info('FINISHED: Scraping of ' + str(len(cities)) + ' cities of ' + args.batch)
+        log_batch_report(cities, batch_started)
+        log_transfer_statistics()
+        log_rate_controller_statistics()
+        log_page_registry_statistics()
+        log_entity_cache_statistics()
+        log_response_cache_statistics()
+    elif args.queue:
+        work_queue = WorkQueue(args.queue, args.visibility_timeout)
+        city_listing_records = dict() if args.review_source == 'listing' else None
+
+        # Store the reviews leased from the queue (discovering the city and hotels if this worker leases them)
+        logger.info('STARTED: Scraping of ' + args.name + ' review data as worker ' + work_queue.owner + ' of ' + args.queue)
+        parse_reviews_of_city(lease_review_urls(work_queue, BASE_URL, CITY_DEFAULT_URL, headers, city_listing_records), CITY_DEFAULT_URL, USER_BASE_URL, session_timestamp, headers, city_listing_records, work_queue=work_queue)
+        logger.info('FINISHED: Scraping of ' + args.name + ' review data as worker ' + work_queue.owner + ' of ' + args.queue)
+
+        log_work_queue_statistics(work_queue)
+        work_queue.close()
+        log_transfer_statistics()
+        log_rate_controller_statistics()
+        log_page_registry_statistics()
+        log_entity_cache_statistics()
+        log_response_cache_statistics()
+    elif not args.pickle or args.pickle == 'store':
         logger.info('STARTED: Scraping of ' + args.name + ' review urls. Build tree "city-pagination-urls--city-hotel-urls--hotel-pagination-urls--hotel-review-urls".')
-        city_pagination_urls = parse_pagination_urls_of_city(CITY_DEFAULT_URL, CITY_URL, number_of_hotels_per_page, headers)
-        city_hotel_urls = parse_hotel_urls_of_city(BASE_URL, city_pagination_urls, headers)
-        hotel_pagination_urls = parse_pagination_urls_of_hotel(city_hotel_urls, headers)
-        city_review_urls = parse_review_urls_of_hotel(BASE_URL, hotel_pagination_urls, headers)
+
+        # The stages are generators, each url is handed downstream as soon as it is discovered
+        city_listing_records = dict() if args.review_source == 'listing' else None
+        city_review_urls = discover_review_urls(BASE_URL, CITY_DEFAULT_URL, headers, city_listing_records)
 
         if args.pickle == 'store':
             # Get the city name from the url
-            occurrences_of_dash = [j for j in range(len(CITY_DEFAULT_URL)) if CITY_DEFAULT_URL.startswith('-', j)]
-            city_name = CITY_DEFAULT_URL[occurrences_of_dash[1] + 1:occurrences_of_dash[2]].lower()
+            city_name = tripadvisor_urls.parse_city_url(CITY_DEFAULT_URL).city_name.lower()
 
             # Build directory name
-            file_path = 'pickle\\' + session_timestamp + '-' + city_name + '.pickle'
+            file_path = os.path.join('pickle', session_timestamp + '-' + city_name + '.frontier')
 
-            with open(file_path, 'wb') as pickle_file:
-                pickle.dump(city_review_urls, pickle_file)
-                logger.info('STORED: Stored review urls list in ' + os.getcwd() + '\\' + file_path)
+            # The review urls list has to be complete before the reviews are scraped, it is appended to the frontier file while it is discovered
+            discovered_review_urls = city_review_urls
+            city_review_urls = tripadvisor_frontier.ReviewFrontier()
 
-        logger.info('FINISHED: Scraping of ' + args.name + ' review urls.')
+            with tripadvisor_frontier.FrontierWriter(file_path) as frontier_writer:
+                for review_url in discovered_review_urls:
+                    city_review_urls.append(review_url)
+                    frontier_writer.append(review_url)
 
-        # Store all reviews of the city
+            logger.info('STORED: Stored review urls list in ' + os.path.join(os.getcwd(), file_path) + ' (' + str(len(city_review_urls)) + ' review urls, ' + str(city_review_urls.get_size()) + ' bytes in memory)')
+
+            logger.info('FINISHED: Scraping of ' + args.name + ' review urls.')
+
+        # Store all reviews of the city (while the review urls are still discovered unless they are stored as frontier)
         logger.info('STARTED: Scraping of ' + args.name + ' review data.')
-        parse_reviews_of_city(city_review_urls, CITY_DEFAULT_URL, USER_BASE_URL, session_timestamp, headers)
+        parse_reviews_of_city(city_review_urls, CITY_DEFAULT_URL, USER_BASE_URL, session_timestamp, headers, city_listing_records, bool(args.resume))
         logger.info('FINISHED: Scraping of ' + args.name + ' review data.')
+
+        if args.pickle != 'store':
+            logger.info('FINISHED: Scraping of ' + args.name + ' review urls.')
+        log_transfer_statistics()
+        log_rate_controller_statistics()
+        log_page_registry_statistics()
+        log_entity_cache_statistics()
+        log_response_cache_statistics()
     else:
-        city_review_urls = list()
-        with open('pickle/' + args.filename, 'rb') as pickle_file:
-            city_review_urls = pickle.load(pickle_file)
-            logger.info('LOADED: Loaded review urls list from ' + os.getcwd() + '\\pickle\\' + args.filename)
+        if args.filename.endswith('.pickle'):
+            # Review urls lists pickled by earlier versions are converted into a frontier while they are loaded
+            with open('pickle/' + args.filename, 'rb') as pickle_file:
+                city_review_urls = tripadvisor_frontier.ReviewFrontier(pickle.load(pickle_file))
+        else:
+            city_review_urls = tripadvisor_frontier.load_frontier('pickle/' + args.filename)
+
+        logger.info('LOADED: Loaded review urls list from ' + os.path.join(os.getcwd(), 'pickle', args.filename) + ' (' + str(len(city_review_urls)) + ' review urls)')
 
         # Store all reviews of the city
         logger.info('STARTED: Scraping of ' + args.name + ' review data.')
-        parse_reviews_of_city(city_review_urls, CITY_DEFAULT_URL, USER_BASE_URL, session_timestamp, headers)
-        logger.info('FINISHED: Scraping of ' + args.name + ' review data.')
\ No newline at end of file
+        parse_reviews_of_city(city_review_urls, CITY_DEFAULT_URL, USER_BASE_URL, session_timestamp, headers, None, bool(args.resume))
+        logger.info('FINISHED: Scraping of ' + args.name + ' review data.')
+        log_transfer_statistics()
+        log_rate_controller_statistics()
+        log_page_registry_statistics()
+        log_entity_cache_statistics()
+        log_response_cache_statistics()
+
+    # Report the progress and metrics of the whole run
+    metrics_stop.set()
+    log_progress((metrics.started, 0, 0))
+
+    if log_sampling.rate > 1:
+        log_event_rollups()
+
+    log_deduplication_statistics()
+
+    # The index is compacted when it is closed
+    if review_index is not None:
+        review_index.close()
+
+    # Pending commits and the write-ahead log of the caches are completed when they are closed
+    if entity_cache is not None:
+        entity_cache.close()
+
+    if response_cache is not None:
+        response_cache.close()
+
+    if review_history is not None:
+        review_history.close()
+
+    if args.metrics_file:
+        write_metrics_file(args.metrics_file)
@@ -4,6 +4,8 @@ import time
 import shutil
 import os
 import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 def get_subdirectories(rootdir):
     return [x[0] for x in os.walk(rootdir)]
@@ -61,7 +63,7 @@ def copy_review_csv_rows(source_directory, destination_directory):
     file_name = ''
 
     for src_file in src_files:
-        if 'reviews' in src_file:
+        if src_file.endswith('-reviews.csv'):
             file_name = src_file
             break
 
@@ -86,7 +88,7 @@ def copy_hotel_information(source_directory, destination_directory):
     file_name = ''
 
     for src_file in src_files:
-        if 'information' in src_file:
+        if src_file.endswith('-information.csv'):
             file_name = src_file
             break
 
@@ -96,31 +98,171 @@ def copy_hotel_information(source_directory, destination_directory):
         shutil.copy(full_file_name, destination_directory)
         logger.info('FINISHED: Copying ' + full_file_name + ' to ' + destination_directory)
 
+# Copies the pack of all review texts (written with --review-texts pack) to destination directory
+def copy_review_pack(source_directory, destination_directory):
+    logger.info('STARTED: Copying ' + source_directory + ' to ' + destination_directory)
+    shutil.copytree(source_directory, destination_directory)
+    logger.info('FINISHED: Copying ' + source_directory + ' to ' + destination_directory)
+
+
+# Copies or hardlinks the review text files of a rating directory to destination directory, files merged before are kept if only_new
+def link_review_files(source_directory, destination_directory, hardlink, only_new=False):
+    for entry in os.scandir(source_directory):
+        if entry.is_file():
+            destination_path = os.path.join(destination_directory, entry.name)
+
+            if only_new and os.path.exists(destination_path):
+                continue
+
+            if hardlink:
+                try:
+                    os.link(entry.path, destination_path)
+                    continue
+                except OSError:
+                    # Hardlinks need the same file system, copy otherwise
+                    pass
+
+            shutil.copyfile(entry.path, destination_path)
+
+# Gets the files of a hotel directory and its state compared with the manifest (size of the reviews csv file, newest modification of the csv files)
+def get_hotel_state(hotel_directory):
+    state = {'reviews': None, 'information': None, 'stars': list(), 'size': 0, 'mtime': 0}
+
+    for entry in os.scandir(hotel_directory):
+        if entry.is_dir() and entry.name in ['1-star', '2-star', '3-star', '4-star', '5-star']:
+            state['stars'].append((entry.name, entry.path))
+        elif entry.is_file() and entry.name.endswith('-information.csv'):
+            state['information'] = entry.path
+            state['mtime'] = max(state['mtime'], entry.stat().st_mtime)
+        elif entry.is_file() and entry.name.endswith('-reviews.csv'):
+            state['reviews'] = entry.path
+            state['size'] = entry.stat().st_size
+            state['mtime'] = max(state['mtime'], entry.stat().st_mtime)
+
+    return state
+
+# Copies the texts and hotel information of a hotel directory, returns the range of its reviews csv file to append as (path, offset, length) or None
+def process_hotel_directory(hotel_directory, state, merged, target_directory, star_directories, hardlink):
+    logger.info('STARTED: Processing of ' + hotel_directory)
+
+    # Text files merged by a previous run are not copied again
+    for star_name, star_path in state['stars']:
+        link_review_files(star_path, star_directories[int(star_name[0]) - 1], hardlink, merged is not None)
+
+    # The hotel information is replaced in place
+    if state['information'] is not None:
+        shutil.copyfile(state['information'], os.path.join(target_directory, os.path.basename(state['information'])))
+
+    reviews_range = None
+
+    if state['reviews'] is not None:
+        if merged is not None and merged['size'] > 0:
+            # Only the rows appended since the previous run are copied
+            offset = merged['size']
+        else:
+            # Only the bytes after the headline are copied (also for a hotel merged before its csv file had been written)
+            with open(state['reviews'], 'rb') as src_csv:
+                offset = len(src_csv.readline())
 
-# Main
-if __name__ == '__main__':
-    # Setup commandline handler
-    parser = argparse.ArgumentParser(description='put together all reviews of a city' , usage='python tripadvisor-totalizer C:\\Users\\Administrator\\tripadvisor-scrapper\\2016-06-01-1522-vienna')
-    parser.add_argument('path', help='path of city directory with reviews')
-    args = parser.parse_args()
+        reviews_range = (state['reviews'], offset, state['size'] - offset)
 
-    # Setup logger
-    session_timestamp = time.strftime('%Y%m%d-%H%M%S')
-    logging.basicConfig(filename='./logs/' + session_timestamp + '-totalizer.log', level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    logger = logging.getLogger(__name__)
-    logging.getLogger().addHandler(logging.StreamHandler())
+    logger.info('FINISHED: Processing of ' + hotel_directory)
 
-    # Get the source directory path and source directory name
-    source_path = args.path
-    source_directory = os.path.basename(os.path.normpath(source_path))
+    return reviews_range
 
-    logger.info('STARTED: Totalizing of ' + source_directory)
+# Counts the rows in a range of a csv file
+def count_rows(path, offset, length):
+    rows = 0
+
+    with open(path, 'rb') as src_csv:
+        src_csv.seek(offset)
+
+        while length > 0:
+            chunk = src_csv.read(min(length, 1024 * 1024))
+
+            if not chunk:
+                break
+
+            rows += chunk.count(b'\n')
+            length -= len(chunk)
+
+    return rows
 
-    # Create the target directory and its subdirectories
-    target_directory = create_session_directory(source_directory)
-    star_directories = create_rating_directories(target_directory)
+# Copies length bytes of a file from an offset into another file at an offset, without passing them through python if possible
+def copy_file_range(source_path, source_offset, destination_path, destination_offset, length):
+    with open(source_path, 'rb') as src_file, open(destination_path, 'r+b') as dest_file:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while length > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), length, source_offset, destination_offset)
 
-    # Create the target file for review csv rows
+                    if copied == 0:
+                        break
+
+                    source_offset += copied
+                    destination_offset += copied
+                    length -= copied
+
+                return
+            except OSError:
+                # Not supported by the file system, continue with a buffered copy
+                pass
+
+        src_file.seek(source_offset)
+        dest_file.seek(destination_offset)
+
+        while length > 0:
+            chunk = src_file.read(min(length, 1024 * 1024))
+
+            if not chunk:
+                break
+
+            dest_file.write(chunk)
+            length -= len(chunk)
+
+# Appends ranges (path, offset, length) of the reviews csv files to the destination file, each range is copied by a worker at its own offset
+def concatenate_review_csv_bodies(reviews_ranges, destination_path, pool):
+    offset = os.path.getsize(destination_path)
+    ranges = list()
+
+    for path, source_offset, length in reviews_ranges:
+        ranges.append((path, source_offset, offset, length))
+        offset += length
+
+    # Allocate the whole file so the workers can write in any order
+    os.truncate(destination_path, offset)
+
+    list(pool.map(lambda copy_range: copy_file_range(copy_range[0], copy_range[1], destination_path, copy_range[2], copy_range[3]), ranges))
+
+# Appends the bytes of the pack files written since the previous run (the pack is append-only), returns the sizes of the files
+def append_review_pack(source_directory, destination_directory, merged_sizes):
+    os.makedirs(destination_directory, exist_ok=True)
+
+    sizes = dict()
+
+    for entry in os.scandir(source_directory):
+        if entry.is_file():
+            destination_path = os.path.join(destination_directory, entry.name)
+            size = entry.stat().st_size
+            offset = merged_sizes.get(entry.name, 0)
+
+            # A pack file repaired after a crash is copied completely
+            if offset > size or not os.path.isfile(destination_path):
+                offset = 0
+
+            logger.info('STARTED: Copying ' + str(size - offset) + ' bytes of ' + entry.path + ' to ' + destination_directory)
+            with open(destination_path, 'ab'):
+                pass
+            os.truncate(destination_path, size)
+            copy_file_range(entry.path, offset, destination_path, offset, size - offset)
+            logger.info('FINISHED: Copying ' + str(size - offset) + ' bytes of ' + entry.path + ' to ' + destination_directory)
+
+            sizes[entry.name] = size
+
+    return sizes
+
+# Creates the target file for review csv rows and writes the headlines into it
+def create_reviews_csv(target_directory):
     with open(target_directory + '/reviews.csv', 'w') as dest_csv:
         writer = csv.writer(dest_csv, delimiter='|', dialect='excel')
 
@@ -137,25 +279,149 @@ if __name__ == '__main__':
             ]
         )
 
-    # Get all subdirectory paths of the source directory
-    sub_directory_paths = get_subdirectories(source_path)
-
-    # Process each subdirectory
-    for sub_directory_path in sub_directory_paths:
-        sub_directory_name = os.path.basename(os.path.normpath(sub_directory_path))
-
-        if sub_directory_name == '1-star':
-            copy_review_files(sub_directory_path, star_directories[0])
-        elif sub_directory_name == '2-star':
-            copy_review_files(sub_directory_path, star_directories[1])
-        elif sub_directory_name == '3-star':
-            copy_review_files(sub_directory_path, star_directories[2])
-        elif sub_directory_name == '4-star':
-            copy_review_files(sub_directory_path, star_directories[3])
-        elif sub_directory_name == '5-star':
-            copy_review_files(sub_directory_path, star_directories[4])
-        else:
-            copy_hotel_information(sub_directory_path, target_directory)
-            copy_review_csv_rows(sub_directory_path, target_directory)
+# Removes everything merged into the target directory by a previous run
+def reset_target_directory(target_directory, star_directories):
+    for star_directory in star_directories:
+        shutil.rmtree(star_directory)
+        os.makedirs(star_directory)
+
+    if os.path.isdir(target_directory + '/reviews-pack'):
+        shutil.rmtree(target_directory + '/reviews-pack')
+
+    create_reviews_csv(target_directory)
+
+# Loads the manifest of the hotels merged into the target directory, None if there is none
+def load_manifest(target_directory):
+    try:
+        with open(target_directory + '/manifest.json', 'r') as manifest_file:
+            return json.load(manifest_file)
+    except:
+        return None
+
+# Stores the manifest (replacing the previous one only once it is written completely)
+def store_manifest(target_directory, manifest):
+    with open(target_directory + '/manifest.json.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+    os.replace(target_directory + '/manifest.json.tmp', target_directory + '/manifest.json')
+
+# Totalizes a session with a pool of workers processing the hotel directories, only hotels new or changed since the manifest are merged
+def totalize_in_parallel(source_path, target_directory, star_directories, workers, hardlink, manifest):
+    hotel_directories = list()
+    pack_directory = None
+
+    for entry in os.scandir(source_path):
+        if entry.is_dir() and entry.name == 'reviews-pack':
+            pack_directory = entry.path
+        elif entry.is_dir():
+            hotel_directories.append(entry.path)
+
+    # Hotels are concatenated in the order of their names
+    hotel_directories.sort()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        states = list(pool.map(get_hotel_state, hotel_directories))
+
+        # Rows can only be appended, a missing manifest or a shrunk csv file requires merging everything again
+        if manifest is None or any(os.path.basename(hotel_directory) in manifest['hotels'] and manifest['hotels'][os.path.basename(hotel_directory)]['size'] > state['size'] for hotel_directory, state in zip(hotel_directories, states)):
+            logger.warning('WARNING: Previous merge of ' + target_directory + ' can not be continued, all hotels are merged again')
+            reset_target_directory(target_directory, star_directories)
+            manifest = {'hotels': dict(), 'pack': dict()}
+
+        # Skip the hotels which did not change since the previous run
+        changed_hotels = list()
+
+        for hotel_directory, state in zip(hotel_directories, states):
+            merged = manifest['hotels'].get(os.path.basename(hotel_directory))
+
+            if merged is None or merged['size'] != state['size'] or merged['mtime'] != state['mtime']:
+                changed_hotels.append((hotel_directory, state, merged))
+
+        logger.info('STARTED: Merging of ' + str(len(changed_hotels)) + ' new or changed of ' + str(len(hotel_directories)) + ' hotels')
+
+        reviews_ranges = list(pool.map(lambda hotel: process_hotel_directory(hotel[0], hotel[1], hotel[2], target_directory, star_directories, hardlink), changed_hotels))
+
+        logger.info('STARTED: Concatenation of ' + str(len(changed_hotels)) + ' review csv files to ' + target_directory + '/reviews.csv')
+        concatenate_review_csv_bodies([reviews_range for reviews_range in reviews_ranges if reviews_range is not None], target_directory + '/reviews.csv', pool)
+        logger.info('FINISHED: Concatenation of ' + str(len(changed_hotels)) + ' review csv files to ' + target_directory + '/reviews.csv')
+
+        # Record the merged state of the hotels
+        rows = list(pool.map(lambda reviews_range: count_rows(*reviews_range) if reviews_range is not None else 0, reviews_ranges))
+
+        for (hotel_directory, state, merged), merged_rows in zip(changed_hotels, rows):
+            manifest['hotels'][os.path.basename(hotel_directory)] = {
+                'size': state['size'], 'mtime': state['mtime'], 'rows': (merged['rows'] if merged is not None else 0) + merged_rows
+            }
+
+        logger.info('FINISHED: Merging of ' + str(len(changed_hotels)) + ' new or changed of ' + str(len(hotel_directories)) + ' hotels')
+
+    if pack_directory is not None:
+        manifest['pack'] = append_review_pack(pack_directory, target_directory + '/reviews-pack', manifest['pack'])
+
+    return manifest
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='put together all reviews of a city' , usage='python tripadvisor-totalizer C:\\Users\\Administrator\\tripadvisor-scrapper\\2016-06-01-1522-vienna')
+    parser.add_argument('path', help='path of city directory with reviews')
+    parser.add_argument('--workers', type=int, default=0, help='the number of workers processing hotel directories in parallel, review csv files are concatenated byte by byte (default: 0, serial)')
+    parser.add_argument('--incremental', action='store_true', help='only merge hotels which are new or changed since the previous run into the existing totalized directory (merges byte by byte like --workers)')
+    parser.add_argument('--hardlink', action='store_true', help='hardlink the review text files instead of copying them (only with --workers)')
+    args = parser.parse_args()
+
+    # Setup logger
+    session_timestamp = time.strftime('%Y%m%d-%H%M%S')
+    logging.basicConfig(filename='./logs/' + session_timestamp + '-totalizer.log', level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(__name__)
+    logging.getLogger().addHandler(logging.StreamHandler())
+
+    # Get the source directory path and source directory name
+    source_path = args.path
+    source_directory = os.path.basename(os.path.normpath(source_path))
+
+    logger.info('STARTED: Totalizing of ' + source_directory)
+
+    # Continue the previous merge of the session or create the target directory and its subdirectories
+    target_directory = os.getcwd() + '/totalized/' + source_directory
+
+    if args.incremental and os.path.isdir(target_directory):
+        star_directories = [target_directory + '/' + str(star) + '-star' for star in [1, 2, 3, 4, 5]]
+        manifest = load_manifest(target_directory)
+    else:
+        target_directory = create_session_directory(source_directory)
+        star_directories = create_rating_directories(target_directory)
+        manifest = {'hotels': dict(), 'pack': dict()}
+
+        # Create the target file for review csv rows
+        create_reviews_csv(target_directory)
+
+    if args.workers > 0 or args.incremental:
+        manifest = totalize_in_parallel(source_path, target_directory, star_directories, max(args.workers, 1), args.hardlink, manifest)
+        store_manifest(target_directory, manifest)
+    else:
+        # Get all subdirectory paths of the source directory
+        sub_directory_paths = get_subdirectories(source_path)
+
+        # Process each subdirectory
+        for sub_directory_path in sub_directory_paths:
+            sub_directory_name = os.path.basename(os.path.normpath(sub_directory_path))
+
+            if sub_directory_name == '1-star':
+                copy_review_files(sub_directory_path, star_directories[0])
+            elif sub_directory_name == '2-star':
+                copy_review_files(sub_directory_path, star_directories[1])
+            elif sub_directory_name == '3-star':
+                copy_review_files(sub_directory_path, star_directories[2])
+            elif sub_directory_name == '4-star':
+                copy_review_files(sub_directory_path, star_directories[3])
+            elif sub_directory_name == '5-star':
+                copy_review_files(sub_directory_path, star_directories[4])
+            elif sub_directory_name == 'reviews-pack':
+                copy_review_pack(sub_directory_path, target_directory + '/reviews-pack')
+            else:
+                copy_hotel_information(sub_directory_path, target_directory)
+                copy_review_csv_rows(sub_directory_path, target_directory)
 
     logger.info('FINISHED: Totalizing of ' + source_directory)
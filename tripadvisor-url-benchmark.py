@@ -0,0 +1,105 @@
+import argparse
+import time
+import tripadvisor_urls
+
+BASE_URL = 'https://www.tripadvisor.com/'
+
+
+# Operations of the scrapper on urls as implemented before the codec, by scanning for the dash positions
+def slice_hotel_name(review_url):
+    occurrences_of_dash = [j for j in range(len(review_url)) if review_url.startswith('-', j)]
+    return review_url[occurrences_of_dash[3] + 1:occurrences_of_dash[4]].replace(' ', '_').lower()
+
+
+def slice_review_key(review_url):
+    occurences_of_dash = [j for j in range(len(review_url)) if review_url.startswith('-', j)]
+    return review_url[occurences_of_dash[0] + 1:occurences_of_dash[3]]
+
+
+def slice_hotel_pagination_url(hotel_url, i):
+    occurrences_of_dash = [j for j in range(len(hotel_url)) if hotel_url.startswith('-', j)]
+    fourth_dash_index = occurrences_of_dash[3]
+    return hotel_url[:fourth_dash_index] + '-or' + str(i * 10) + hotel_url[fourth_dash_index:] + '#REVIEWS'
+
+
+def slice_city_name(city_url):
+    occurrences_of_dash = [j for j in range(len(city_url)) if city_url.startswith('-', j)]
+    return city_url[occurrences_of_dash[1] + 1:occurrences_of_dash[2]].lower()
+
+
+# The same operations with the codec
+def codec_hotel_name(review_url):
+    return tripadvisor_urls.parse_review_url(review_url).hotel_name.replace(' ', '_').lower()
+
+
+def codec_review_key(review_url):
+    return tripadvisor_urls.get_review_key(tripadvisor_urls.parse_review_url(review_url))
+
+
+def codec_hotel_pagination_url(hotel_url, i):
+    return tripadvisor_urls.get_hotel_pagination_url(hotel_url, i * 10, '#REVIEWS')
+
+
+def codec_city_name(city_url):
+    return tripadvisor_urls.parse_city_url(city_url).city_name.lower()
+
+
+# Build the sample urls of a city (the hotel names contain no dashes, which the slicing can not handle)
+def build_sample_urls(number_of_hotels, reviews_per_hotel):
+    city_url = 'Hotels-g190454-Vienna-Hotels.html'
+    hotel_urls = list()
+    review_urls = list()
+
+    for hotel in range(number_of_hotels):
+        hotel_url = tripadvisor_urls.HotelUrl(BASE_URL, 190454, 80000 + hotel, 0, 'Hotel_Name_Number_' + str(hotel), 'Vienna', '')
+        hotel_urls.append(tripadvisor_urls.build_hotel_url(hotel_url))
+
+        for review in range(reviews_per_hotel):
+            review_url = tripadvisor_urls.ReviewUrl(BASE_URL, 190454, 80000 + hotel, 300000000 + hotel * reviews_per_hotel + review, 'Hotel_Name_Number_' + str(hotel), 'Vienna', '')
+            review_urls.append(tripadvisor_urls.build_review_url(review_url))
+
+    return city_url, hotel_urls, review_urls
+
+
+# Run an operation over all items, returns the duration and the results
+def run_operation(operation, items, repeat):
+    started = time.perf_counter()
+
+    for i in range(repeat):
+        results = [operation(*item) for item in items]
+
+    return time.perf_counter() - started, results
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='compare the throughput of the url codec with the slicing at dash positions', usage='python tripadvisor-url-benchmark.py [--hotels 100] [--reviews 100] [--repeat 3]')
+    parser.add_argument('--hotels', type=int, default=100, help='the number of sample hotels (default: 100)')
+    parser.add_argument('--reviews', type=int, default=100, help='the number of sample reviews per hotel (default: 100)')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of rounds over all urls (default: 3)')
+    args = parser.parse_args()
+
+    city_url, hotel_urls, review_urls = build_sample_urls(args.hotels, args.reviews)
+
+    operations = [
+        ('hotel name', slice_hotel_name, codec_hotel_name, [(review_url, ) for review_url in review_urls]),
+        ('review key', slice_review_key, codec_review_key, [(review_url, ) for review_url in review_urls]),
+        ('hotel page url', slice_hotel_pagination_url, codec_hotel_pagination_url, [(hotel_url, i) for hotel_url in hotel_urls for i in range(1, 11)]),
+        ('city name', slice_city_name, codec_city_name, [(city_url, )] * len(hotel_urls))
+    ]
+
+    print('%d hotel urls, %d review urls, %d rounds' % (len(hotel_urls), len(review_urls), args.repeat))
+
+    for name, slice_operation, codec_operation, items in operations:
+        slice_duration, slice_results = run_operation(slice_operation, items, args.repeat)
+        codec_duration, codec_results = run_operation(codec_operation, items, args.repeat)
+
+        print('%-16s slicing %10.0f urls/s  codec %10.0f urls/s  %6.2fx  %s' % (
+            name, len(items) * args.repeat / slice_duration, len(items) * args.repeat / codec_duration, slice_duration / codec_duration,
+            'same results' if slice_results == codec_results else 'DIFFERENT RESULTS'
+        ))
+
+    # Hotel names with dashes are cut off by the slicing
+    review_url = BASE_URL + 'ShowUserReviews-g187147-d197528-r123456-Hotel_Le_Six-Saint_Germain-Paris_Ile_de_France.html'
+    print('hotel name with dashes: slicing %s, codec %s' % (slice_hotel_name(review_url), codec_hotel_name(review_url)))
@@ -0,0 +1,233 @@
+import argparse
+import os
+import struct
+import pickle
+from array import array
+from collections import namedtuple
+import tripadvisor_urls
+
+# First bytes of a frontier file
+FRONTIER_MAGIC = b'TAFRONTIER1\n'
+
+# Slug record: tag, length of the url prefix and of the url suffix (followed by both as UTF-8)
+SLUG_RECORD = struct.Struct('<cHH')
+
+# Review record: tag, geo id, hotel id, review id and slug reference
+REVIEW_RECORD = struct.Struct('<cIIQI')
+
+# A review url of a frontier, the slug (url prefix and suffix) is shared by all reviews of a hotel
+FrontierEntry = namedtuple('FrontierEntry', ['geo_id', 'hotel_id', 'review_id', 'prefix', 'suffix'])
+
+
+# Splits a review url into its ids and slug, raises ValueError for other urls
+def parse_review_url(review_url):
+    review = tripadvisor_urls.parse_review_url(review_url)
+
+    return FrontierEntry(review.geo_id, review.hotel_id, review.review_id, review.prefix, review.hotel_name + '-' + review.city_name + '.html' + review.fragment)
+
+
+# Rebuilds the review url of an entry
+def build_review_url(entry):
+    return entry.prefix + 'ShowUserReviews-g' + str(entry.geo_id) + '-d' + str(entry.hotel_id) + '-r' + str(entry.review_id) + '-' + entry.suffix
+
+
+# Review urls stored as integer columns and a table of slugs, the urls are rebuilt when they are read
+class ReviewFrontier(object):
+    def __init__(self, review_urls=()):
+        self.geo_ids = array('I')
+        self.hotel_ids = array('I')
+        self.review_ids = array('Q')
+        self.slug_refs = array('I')
+
+        # Slugs (url prefix and suffix) in the order of their first use and their references
+        self.slugs = list()
+        self.slug_references = dict()
+
+        self.extend(review_urls)
+
+    # Returns the reference of a slug, unknown slugs are added to the table
+    def get_slug_reference(self, slug):
+        slug_reference = self.slug_references.get(slug)
+
+        if slug_reference is None:
+            slug_reference = self.slug_references[slug] = len(self.slugs)
+            self.slugs.append(slug)
+
+        return slug_reference
+
+    def append(self, review_url):
+        entry = parse_review_url(review_url)
+
+        self.geo_ids.append(entry.geo_id)
+        self.hotel_ids.append(entry.hotel_id)
+        self.review_ids.append(entry.review_id)
+        self.slug_refs.append(self.get_slug_reference((entry.prefix, entry.suffix)))
+
+    def extend(self, review_urls):
+        for review_url in review_urls:
+            self.append(review_url)
+
+    def get_entry(self, position):
+        prefix, suffix = self.slugs[self.slug_refs[position]]
+
+        return FrontierEntry(self.geo_ids[position], self.hotel_ids[position], self.review_ids[position], prefix, suffix)
+
+    def __len__(self):
+        return len(self.review_ids)
+
+    def __getitem__(self, position):
+        return build_review_url(self.get_entry(position))
+
+    def __iter__(self):
+        for position in range(len(self.review_ids)):
+            yield build_review_url(self.get_entry(position))
+
+    # Bytes held by the columns (the slug table is shared by all reviews of a hotel)
+    def get_size(self):
+        return sum(column.itemsize * len(column) for column in [self.geo_ids, self.hotel_ids, self.review_ids, self.slug_refs])
+
+
+# Yields the records of a frontier file as tag, fields and the position after the record, a record cut off by a crash ends the file
+def read_records(frontier_file, chunk_size=1 << 20):
+    if frontier_file.read(len(FRONTIER_MAGIC)) != FRONTIER_MAGIC:
+        raise ValueError(frontier_file.name + ' is not a review frontier')
+
+    buffer = b''
+    position = len(FRONTIER_MAGIC)
+
+    while True:
+        chunk = frontier_file.read(chunk_size)
+
+        if not chunk:
+            return
+
+        buffer += chunk
+        offset = 0
+
+        while True:
+            tag = buffer[offset:offset + 1]
+
+            if tag == b'R' and offset + REVIEW_RECORD.size <= len(buffer):
+                fields = REVIEW_RECORD.unpack_from(buffer, offset)[1:]
+                offset += REVIEW_RECORD.size
+            elif tag == b'S' and offset + SLUG_RECORD.size <= len(buffer):
+                prefix_length, suffix_length = SLUG_RECORD.unpack_from(buffer, offset)[1:]
+                start = offset + SLUG_RECORD.size
+
+                if start + prefix_length + suffix_length > len(buffer):
+                    break
+
+                fields = (buffer[start:start + prefix_length].decode('utf-8'), buffer[start + prefix_length:start + prefix_length + suffix_length].decode('utf-8'))
+                offset = start + prefix_length + suffix_length
+            elif tag in (b'', b'R', b'S'):
+                break
+            else:
+                raise ValueError(frontier_file.name + ' is corrupt at byte ' + str(position + offset))
+
+            yield tag, fields, position + offset
+
+        buffer = buffer[offset:]
+        position += offset
+
+
+# Yields the review urls of a frontier file while it is read
+def read_review_urls(path):
+    slugs = list()
+
+    with open(path, 'rb') as frontier_file:
+        for tag, fields, position in read_records(frontier_file):
+            if tag == b'S':
+                slugs.append(fields)
+            else:
+                geo_id, hotel_id, review_id, slug_reference = fields
+                yield build_review_url(FrontierEntry(geo_id, hotel_id, review_id, *slugs[slug_reference]))
+
+
+# Reads a frontier file into memory without rebuilding its urls
+def load_frontier(path):
+    frontier = ReviewFrontier()
+
+    with open(path, 'rb') as frontier_file:
+        for tag, fields, position in read_records(frontier_file):
+            if tag == b'S':
+                frontier.get_slug_reference(fields)
+            else:
+                frontier.geo_ids.append(fields[0])
+                frontier.hotel_ids.append(fields[1])
+                frontier.review_ids.append(fields[2])
+                frontier.slug_refs.append(fields[3])
+
+    return frontier
+
+
+# Appends review urls to a frontier file, a slug is written once before the first review using it
+class FrontierWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.slug_references = dict()
+
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as frontier_file:
+                frontier_file.write(FRONTIER_MAGIC)
+
+        # The slugs of an existing file are read again, a record written partially before a crash is cut off
+        end = len(FRONTIER_MAGIC)
+
+        with open(path, 'rb') as frontier_file:
+            for tag, fields, end in read_records(frontier_file):
+                if tag == b'S':
+                    self.slug_references[fields] = len(self.slug_references)
+
+        self.frontier_file = open(path, 'ab')
+        self.frontier_file.truncate(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, review_url):
+        entry = parse_review_url(review_url)
+        slug = (entry.prefix, entry.suffix)
+        slug_reference = self.slug_references.get(slug)
+
+        if slug_reference is None:
+            slug_reference = self.slug_references[slug] = len(self.slug_references)
+            prefix, suffix = entry.prefix.encode('utf-8'), entry.suffix.encode('utf-8')
+            self.frontier_file.write(SLUG_RECORD.pack(b'S', len(prefix), len(suffix)) + prefix + suffix)
+
+        self.frontier_file.write(REVIEW_RECORD.pack(b'R', entry.geo_id, entry.hotel_id, entry.review_id, slug_reference))
+
+    def extend(self, review_urls):
+        for review_url in review_urls:
+            self.append(review_url)
+
+    def flush(self):
+        self.frontier_file.flush()
+
+    def close(self):
+        self.frontier_file.close()
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='convert a pickled review urls list into a review frontier or summarize a review frontier', usage='python tripadvisor_frontier.py pickle/20160601-1522-vienna.pickle [--output pickle/20160601-1522-vienna.frontier]')
+    parser.add_argument('path', help='path of the pickle file to convert or of the frontier file to summarize')
+    parser.add_argument('--output', help='path of the converted frontier file (default: the path of the pickle file with .frontier)')
+    args = parser.parse_args()
+
+    if args.path.endswith('.pickle'):
+        output_path = args.output or os.path.splitext(args.path)[0] + '.frontier'
+
+        with open(args.path, 'rb') as pickle_file:
+            review_urls = pickle.load(pickle_file)
+
+        with FrontierWriter(output_path) as writer:
+            writer.extend(review_urls)
+
+        print('%d review urls of %s (%d bytes) converted into %s (%d bytes)' % (len(review_urls), args.path, os.path.getsize(args.path), output_path, os.path.getsize(output_path)))
+    else:
+        frontier = load_frontier(args.path)
+        print('%d review urls of %d hotels, %d bytes in memory, %d bytes on disk' % (len(frontier), len(set(frontier.hotel_ids)), frontier.get_size(), os.path.getsize(args.path)))
@@ -0,0 +1,234 @@
+import argparse
+import os
+import mmap
+import struct
+import zlib
+from collections import namedtuple, OrderedDict, Counter
+
+# Files of a pack directory
+PACK_FILE_NAME = 'reviews.pack'
+INDEX_FILE_NAME = 'reviews.idx'
+HOTELS_FILE_NAME = 'hotels.txt'
+
+# Index record of a review: review id, hotel number, rating, offset and length of its block, offset and length of its text in the block
+INDEX_RECORD = struct.Struct('<QIBQIII')
+
+# A review read from a pack
+PackedReview = namedtuple('PackedReview', ['review_id', 'hotel', 'rating', 'text'])
+
+# A review's position in a pack
+IndexEntry = namedtuple('IndexEntry', ['review_id', 'hotel', 'rating', 'block_offset', 'block_length', 'text_offset', 'text_length'])
+
+
+# Appends review texts as zlib compressed UTF-8 blocks to a pack, one block per flush
+class ReviewPackWriter(object):
+    def __init__(self, directory_path, compression_level=6):
+        self.directory_path = directory_path
+        self.compression_level = compression_level
+
+        if not os.path.isdir(directory_path):
+            os.makedirs(directory_path)
+
+        # Hotel names are stored once, the index refers to their line number
+        self.hotels = dict()
+
+        if os.path.isfile(os.path.join(directory_path, HOTELS_FILE_NAME)):
+            with open(os.path.join(directory_path, HOTELS_FILE_NAME), 'r', encoding='utf-8') as hotels_file:
+                for line in hotels_file:
+                    self.hotels[line.rstrip('\n')] = len(self.hotels)
+
+        self.pack_file = open(os.path.join(directory_path, PACK_FILE_NAME), 'ab')
+        self.index_file = open(os.path.join(directory_path, INDEX_FILE_NAME), 'ab')
+        self.hotels_file = open(os.path.join(directory_path, HOTELS_FILE_NAME), 'a', encoding='utf-8')
+
+        self.repair()
+
+        # Texts of the next block (review id, hotel number, rating, encoded text)
+        self.texts = list()
+
+    # Cuts off a block or index record which was written partially before a crash
+    def repair(self):
+        index_size = os.path.getsize(self.index_file.name)
+        self.index_file.truncate(index_size - index_size % INDEX_RECORD.size)
+        self.index_file.seek(0, os.SEEK_END)
+
+        pack_size = 0
+
+        if index_size >= INDEX_RECORD.size:
+            with open(self.index_file.name, 'rb') as index_file:
+                index_file.seek((index_size // INDEX_RECORD.size - 1) * INDEX_RECORD.size)
+                last_entry = IndexEntry(*INDEX_RECORD.unpack(index_file.read(INDEX_RECORD.size)))
+                pack_size = last_entry.block_offset + last_entry.block_length
+
+        self.pack_file.truncate(pack_size)
+        self.pack_file.seek(0, os.SEEK_END)
+
+    def add(self, review_id, hotel_name, rating, text):
+        if hotel_name not in self.hotels:
+            self.hotels[hotel_name] = len(self.hotels)
+            self.hotels_file.write(hotel_name + '\n')
+
+        self.texts.append((review_id, self.hotels[hotel_name], rating, text.encode('utf-8')))
+
+    # Writes the added texts as one block, the index is written after the block and the hotel names so it never refers to missing data
+    def flush(self):
+        if not self.texts:
+            return
+
+        self.hotels_file.flush()
+        os.fsync(self.hotels_file.fileno())
+
+        block = zlib.compress(b''.join(text for review_id, hotel, rating, text in self.texts), self.compression_level)
+        block_offset = self.pack_file.tell()
+
+        self.pack_file.write(block)
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+
+        records = list()
+        text_offset = 0
+
+        for review_id, hotel, rating, text in self.texts:
+            records.append(INDEX_RECORD.pack(review_id, hotel, rating, block_offset, len(block), text_offset, len(text)))
+            text_offset += len(text)
+
+        self.index_file.write(b''.join(records))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+        self.texts = list()
+
+    def close(self):
+        self.flush()
+        self.pack_file.close()
+        self.index_file.close()
+        self.hotels_file.close()
+
+
+# Reads reviews of a pack through memory maps, only the blocks of the requested reviews are decompressed
+class ReviewPackReader(object):
+    def __init__(self, directory_path, cached_blocks=16):
+        with open(os.path.join(directory_path, HOTELS_FILE_NAME), 'r', encoding='utf-8') as hotels_file:
+            self.hotels = [line.rstrip('\n') for line in hotels_file]
+
+        self.pack_file = open(os.path.join(directory_path, PACK_FILE_NAME), 'rb')
+        self.index_file = open(os.path.join(directory_path, INDEX_FILE_NAME), 'rb')
+        self.pack = self.map_file(self.pack_file)
+        self.index = self.map_file(self.index_file)
+        self.count = len(self.index) // INDEX_RECORD.size
+
+        # Recently decompressed blocks by their offset
+        self.blocks = OrderedDict()
+        self.cached_blocks = cached_blocks
+
+        # Position of each review id (built on the first random access)
+        self.positions = None
+
+    @staticmethod
+    def map_file(file):
+        # Empty files can not be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self.read(position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_entry(self, position):
+        return IndexEntry(*INDEX_RECORD.unpack_from(self.index, position * INDEX_RECORD.size))
+
+    def get_block(self, block_offset, block_length):
+        if block_offset in self.blocks:
+            self.blocks.move_to_end(block_offset)
+            return self.blocks[block_offset]
+
+        block = zlib.decompress(self.pack[block_offset:block_offset + block_length])
+        self.blocks[block_offset] = block
+
+        if len(self.blocks) > self.cached_blocks:
+            self.blocks.popitem(last=False)
+
+        return block
+
+    # Reads the review at a position of the index
+    def read(self, position):
+        entry = self.get_entry(position)
+        block = self.get_block(entry.block_offset, entry.block_length)
+        text = block[entry.text_offset:entry.text_offset + entry.text_length].decode('utf-8')
+
+        return PackedReview(entry.review_id, self.hotels[entry.hotel], entry.rating, text)
+
+    # Returns the review with a review id, None if it is not in the pack
+    def get(self, review_id):
+        if self.positions is None:
+            self.positions = dict((self.get_entry(position).review_id, position) for position in range(self.count))
+
+        position = self.positions.get(review_id)
+
+        return None if position is None else self.read(position)
+
+    # Yields the reviews with a rating (1 to 5 stars)
+    def by_rating(self, rating):
+        for position in range(self.count):
+            if self.index[position * INDEX_RECORD.size + 12] == rating:
+                yield self.read(position)
+
+    # Yields the reviews of a hotel
+    def by_hotel(self, hotel_name):
+        if hotel_name not in self.hotels:
+            return
+
+        hotel = self.hotels.index(hotel_name)
+
+        for position in range(self.count):
+            if self.get_entry(position).hotel == hotel:
+                yield self.read(position)
+
+    def close(self):
+        if isinstance(self.pack, mmap.mmap):
+            self.pack.close()
+
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+
+        self.pack_file.close()
+        self.index_file.close()
+
+
+# Main
+if __name__ == '__main__':
+    # Setup commandline handler
+    parser = argparse.ArgumentParser(description='summarize or print the reviews of a review pack', usage='python tripadvisor_pack.py data/20160716-202314-vienna/reviews-pack [--rating 5] [--hotel hotel_name]')
+    parser.add_argument('path', help='path of the pack directory')
+    parser.add_argument('--rating', type=int, choices=[1, 2, 3, 4, 5], help='print the reviews with this rating')
+    parser.add_argument('--hotel', help='print the reviews of this hotel')
+    args = parser.parse_args()
+
+    with ReviewPackReader(args.path) as reader:
+        if args.rating:
+            reviews = reader.by_rating(args.rating)
+        elif args.hotel:
+            reviews = reader.by_hotel(args.hotel)
+        else:
+            reviews = None
+
+        if reviews is None:
+            ratings = Counter(reader.get_entry(position).rating for position in range(len(reader)))
+            print('%d reviews of %d hotels' % (len(reader), len(reader.hotels)))
+
+            for rating in sorted(ratings):
+                print('%d stars: %d reviews' % (rating, ratings[rating]))
+        else:
+            for review in reviews:
+                print('%d|%s|%d|%s' % review)
@@ -0,0 +1,134 @@
+import re
+from collections import namedtuple
+
+# City page, e.g. Hotels-g190454-oa30-Vienna-Hotels.html#ACCOM_OVERVIEW (the city name may contain dashes)
+CITY_URL_PATTERN = re.compile(r'(.*?)Hotels-g(\d+)(?:-oa(\d+))?-(.+)-Hotels\.html(#.*)?$', re.DOTALL)
+
+# Hotel review page, e.g. Hotel_Review-g190454-d86853-Reviews-or10-Hotel_Sacher_Wien-Vienna.html#REVIEWS (hotel and city name may contain dashes, they are split by split_names)
+HOTEL_URL_PATTERN = re.compile(r'(.*?)Hotel_Review-g(\d+)-d(\d+)-Reviews(?:-or(\d+))?-(.+-[^-]+)\.html(#.*)?$', re.DOTALL)
+
+# Review page, e.g. ShowUserReviews-g190454-d86853-r384938462-Hotel_Sacher_Wien-Vienna.html
+REVIEW_URL_PATTERN = re.compile(r'(.*?)ShowUserReviews-g(\d+)-d(\d+)-r(\d+)-(.+-[^-]+)\.html(#.*)?$', re.DOTALL)
+
+# Member profile page, e.g. members/JohnDoe
+MEMBER_URL_PATTERN = re.compile(r'(.*?)members/([^/?#]+)$', re.DOTALL)
+
+# Parts of the urls, the prefix is the text before the page name (e.g. the base url) and the fragment includes the #
+CityUrl = namedtuple('CityUrl', ['prefix', 'geo_id', 'offset', 'city_name', 'fragment'])
+HotelUrl = namedtuple('HotelUrl', ['prefix', 'geo_id', 'hotel_id', 'offset', 'hotel_name', 'city_name', 'fragment'])
+ReviewUrl = namedtuple('ReviewUrl', ['prefix', 'geo_id', 'hotel_id', 'review_id', 'hotel_name', 'city_name', 'fragment'])
+MemberUrl = namedtuple('MemberUrl', ['prefix', 'user_name'])
+
+# Lower case names of the cities of the registered city urls by geo id
+city_names = dict()
+
+
+# Matches a url against a pattern, raises ValueError for urls of other pages
+def match_url(pattern, url, kind):
+    match = pattern.match(url)
+
+    if match is None:
+        raise ValueError('not a ' + kind + ' url: ' + url)
+
+    return match
+
+
+# Splits the names of a hotel or review url (e.g. Hotel_Sacher_Wien-Vienna) into hotel and city name,
+# the city name is the one of the registered city url of the geo id, otherwise the part after the last dash
+def split_names(geo_id, names):
+    city_name = city_names.get(geo_id)
+
+    if city_name is not None and len(names) > len(city_name) + 1 and names.lower().endswith('-' + city_name):
+        return names[:-len(city_name) - 1], names[-len(city_name):]
+
+    hotel_name, _, city_name = names.rpartition('-')
+
+    return hotel_name, city_name
+
+
+def parse_city_url(url):
+    prefix, geo_id, offset, city_name, fragment = match_url(CITY_URL_PATTERN, url, 'city').groups()
+
+    return CityUrl(prefix, int(geo_id), int(offset or 0), city_name, fragment or '')
+
+
+# Parses a city url and registers the name of the city, hotel and review urls of the city are split according to it
+def register_city_url(url):
+    city = parse_city_url(url)
+    city_names[city.geo_id] = city.city_name.lower()
+
+    return city
+
+
+def parse_hotel_url(url):
+    prefix, geo_id, hotel_id, offset, names, fragment = match_url(HOTEL_URL_PATTERN, url, 'hotel').groups()
+    geo_id = int(geo_id)
+
+    return HotelUrl(prefix, geo_id, int(hotel_id), int(offset or 0), *split_names(geo_id, names), fragment or '')
+
+
+def parse_review_url(url):
+    prefix, geo_id, hotel_id, review_id, names, fragment = match_url(REVIEW_URL_PATTERN, url, 'review').groups()
+    geo_id = int(geo_id)
+
+    return ReviewUrl(prefix, geo_id, int(hotel_id), int(review_id), *split_names(geo_id, names), fragment or '')
+
+
+def parse_member_url(url):
+    return MemberUrl(*match_url(MEMBER_URL_PATTERN, url, 'member').groups())
+
+
+# Parses a url of any of the pages above
+def parse_url(url):
+    if 'ShowUserReviews-' in url:
+        return parse_review_url(url)
+    elif 'Hotel_Review-' in url:
+        return parse_hotel_url(url)
+    elif 'Hotels-' in url:
+        return parse_city_url(url)
+
+    return parse_member_url(url)
+
+
+# Builds the url of a city page, the offset counts the hotels listed on the previous pages
+def build_city_url(city):
+    return city.prefix + 'Hotels-g' + str(city.geo_id) + ('-oa' + str(city.offset) if city.offset else '') + '-' + city.city_name + '-Hotels.html' + city.fragment
+
+
+# Builds the url of a hotel review page, the offset counts the reviews listed on the previous pages
+def build_hotel_url(hotel):
+    return hotel.prefix + 'Hotel_Review-g' + str(hotel.geo_id) + '-d' + str(hotel.hotel_id) + '-Reviews' + ('-or' + str(hotel.offset) if hotel.offset else '') + '-' + hotel.hotel_name + '-' + hotel.city_name + '.html' + hotel.fragment
+
+
+def build_review_url(review):
+    return review.prefix + 'ShowUserReviews-g' + str(review.geo_id) + '-d' + str(review.hotel_id) + '-r' + str(review.review_id) + '-' + review.hotel_name + '-' + review.city_name + '.html' + review.fragment
+
+
+def build_member_url(member):
+    return member.prefix + 'members/' + member.user_name
+
+
+# Builds the url of the city page listing the hotels from offset on (e.g. -oa30-)
+def get_city_pagination_url(city_url, offset, fragment=None):
+    city = parse_city_url(city_url)
+
+    return build_city_url(city._replace(offset=offset, fragment=city.fragment if fragment is None else fragment))
+
+
+# Builds the url of the hotel review page listing the reviews from offset on (e.g. -or10-)
+def get_hotel_pagination_url(hotel_url, offset, fragment=None):
+    hotel = parse_hotel_url(hotel_url)
+
+    return build_hotel_url(hotel._replace(offset=offset, fragment=hotel.fragment if fragment is None else fragment))
+
+
+# Geo and location id of the hotel of a hotel or review url (e.g. g190454-d86853)
+def get_hotel_location(url):
+    hotel = parse_url(url)
+
+    return 'g' + str(hotel.geo_id) + '-d' + str(hotel.hotel_id)
+
+
+# Key of a review used for file names (e.g. g190454-d86853-r384938462)
+def get_review_key(review):
+    return 'g' + str(review.geo_id) + '-d' + str(review.hotel_id) + '-r' + str(review.review_id)